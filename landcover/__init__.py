@@ -0,0 +1,15 @@
+"""Local processing pipeline behind the Lucas land-cover Streamlit pages.
+
+The pages only present results; the modules in this package produce them
+(classification of regional Sentinel-2 slices with the trained RF and MLP
+models).
+"""
+
+# one-digit Lucas land-cover classes, in the order used by the masks:
+# mask value 0 is out-of-area, 1..8 are A..H
+CLASS_CODES = 'ABCDEFGH'
+
+CLASS_NAMES = ['Artificial Land', 'Cropland', 'Woodland', 'Shrubland',
+               'Greenland', 'Bareland', 'Water', 'Wetlands']
+
+N_BANDS = 12
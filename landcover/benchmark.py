@@ -0,0 +1,397 @@
+"""Performance benchmarks of the pipeline on synthetic Sentinel-2 data.
+
+The download, training and classification times were only known from a few
+notes on the pages ("3 to 4 hours" for the download, RF 3x3 too slow for
+more than two trials). This suite measures every stage on synthetic uint16,
+12-band data shaped like the real inputs:
+
+* ``extraction``: patches per second through :func:`landcover.extraction.extract`
+  with the offline :class:`~landcover.extraction.LocalBackend`;
+* ``flatten``: 3x3 patches to training rows, and slice blocks to 1x1/3x3
+  feature batches;
+* ``train_rf_1x1``/``train_rf_3x3``/``train_mlp_1x1``/``train_mlp_3x3``: one
+  fit with the structures chosen on the Algorithms training page (3x3 with
+  flips/rotations). MLP fits run a few epochs only and need TensorFlow;
+  without it they are reported as skipped;
+* ``predict_*``: pixels per second on one core of the scikit-learn forest
+  and the NumPy MLP runtime;
+* ``precision_mlp_*``: agreement of float16 and int8 MLP weights with
+  float32 (:func:`landcover.mlp.compare_precisions`) for :func:`random_mlp`
+  on :func:`synthetic_patches` pixels;
+* ``classify_*``: end-to-end :func:`landcover.classification.classify_region`
+  on a synthetic slice with every core.
+
+Each stage runs in a fresh process and, on Linux, every timed step resets
+the peak resident memory when it starts (see :mod:`landcover.timing`), so
+the peak it reports is its own: ``predict_rf_*`` does not include the forest
+fit, nor ``feature_batches_*`` the patch flattening. Results are written as JSON together with the machine they ran
+on, and :func:`compare` lists the stages that got slower or bigger between
+two runs::
+
+    python -m landcover.benchmark --out benchmarks
+    python -m landcover.benchmark --out benchmarks --compare benchmarks/<old>.json
+"""
+
+import argparse
+import datetime
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from landcover import CLASS_CODES, N_BANDS, timing
+
+
+N_CLASSES = len(CLASS_CODES)
+
+# structures chosen by the tuning step (Algorithms training page)
+RF_PARAMS = {1 : {'n_estimators' : 100, 'max_samples' : 2800, 'max_features' : 9},
+             3 : {'n_estimators' : 100, 'max_samples' : 2600, 'max_features' : 41}}
+MLP_LAYERS = (128, 64, 32)
+
+# problem sizes at scale 1
+SIZES = {'extraction_points' : 20000,
+         'patches' : 40000,
+         'pixels' : 200000,
+         'slice_side' : 2048,
+         'mlp_epochs' : 5}
+
+
+### SYNTHETIC DATA ############################################################
+
+def synthetic_patches(n, seed = 0):
+    """(n, 3, 3, 12) uint16 patches and their classes (0..7).
+
+    Every class has its own mean spectrum, shared by the nine pixels of a
+    patch up to noise, so the models have something to learn.
+    """
+    rng = np.random.default_rng(seed)
+    centres = rng.uniform(300, 6000, (N_CLASSES, N_BANDS))
+    labels = rng.integers(0, N_CLASSES, n)
+    patches = centres[labels][:, None, None, :] + rng.normal(0, 900, (n, 3, 3, N_BANDS))
+    return np.clip(patches, 0, 10000).astype(np.uint16), labels.astype(np.uint8)
+
+
+def synthetic_slice(path, side, seed = 0):
+    """Write a (side, side, 12) uint16 slice of smooth class patches to ``path``."""
+    rng = np.random.default_rng(seed)
+    centres = rng.uniform(300, 6000, (N_CLASSES, N_BANDS)).astype(np.float32)
+    cell = 32
+    n_cells = -(-side // cell)
+    classes = rng.integers(0, N_CLASSES, (n_cells, n_cells))
+    classes = np.repeat(np.repeat(classes, cell, axis = 0), cell, axis = 1)[:side, :side]
+    array = np.lib.format.open_memmap(path, mode = 'w+', dtype = np.uint16,
+                                      shape = (side, side, N_BANDS))
+    for r0 in range(0, side, cell):
+        block = centres[classes[r0:r0 + cell]]
+        block += rng.normal(0, 900, block.shape).astype(np.float32)
+        array[r0:r0 + cell] = np.clip(block, 0, 10000)
+    array.flush()
+    del array
+    return path
+
+
+def random_mlp(path, n_features, seed = 0, precision = 'float32'):
+    """Save an untrained 128/64/32 MLP of the exported format to ``path``."""
+    from landcover.mlp import save_mlp
+    rng = np.random.default_rng(seed)
+    sizes = (n_features,) + MLP_LAYERS + (N_CLASSES,)
+    layers = []
+    for i, (n_in, n_out) in enumerate(zip(sizes[:-1], sizes[1:])):
+        activation = 'softmax' if i == len(sizes) - 2 else 'relu'
+        layers.append((rng.normal(0, np.sqrt(2 / n_in), (n_in, n_out)),
+                       rng.normal(0, 0.1, n_out), activation))
+    save_mlp(path, layers, input_scale = 1 / 10000, precision = precision)
+    return path
+
+
+### STAGES ####################################################################
+
+def bench_extraction(sizes, workdir, workers):
+    from landcover.extraction import LocalBackend, LucasPoint, extract
+    rng = np.random.default_rng(0)
+    n = sizes['extraction_points']
+    lats = rng.uniform(36, 60, n)
+    lons = rng.uniform(-9, 25, n)
+    dates = [datetime.date(2018, 3, 1) + datetime.timedelta(days = int(d))
+             for d in rng.integers(0, 180, n)]
+    points = [LucasPoint(f'{i:08d}', lat, lon, date, CLASS_CODES[i % N_CLASSES], 'IT', 0)
+              for i, (lat, lon, date) in enumerate(zip(lats, lons, dates))]
+    extract(points, LocalBackend(), os.path.join(workdir, 'extraction'),
+            workers = workers)
+
+
+def bench_flatten(sizes, workdir, workers):
+    from landcover.features import centre_pixel, flatten_patches, iter_feature_batches
+    patches, _ = synthetic_patches(sizes['patches'])
+    with timing.stage('flatten_patches', items = len(patches)):
+        centre_pixel(flatten_patches(patches)).copy()
+    side = int(np.sqrt(sizes['pixels']))
+    block = np.random.default_rng(0).integers(0, 10000, (side + 2, side + 2, N_BANDS),
+                                              dtype = np.uint16)
+    for window in (1, 3):
+        halo = window // 2
+        core = block[1 - halo:side + 1 + halo, 1 - halo:side + 1 + halo]
+        with timing.stage(f'feature_batches_{window}x{window}', items = side * side):
+            for _ in iter_feature_batches(core, window):
+                pass
+
+
+def _training_data(sizes, window):
+    from landcover.features import centre_pixel, flatten_patches
+    from landcover.experiments import dihedral_permutations, split_indices
+    patches, y = synthetic_patches(sizes['patches'])
+    X = flatten_patches(patches)
+    if window == 1:
+        X = centre_pixel(X)
+    train, val, test = split_indices(len(y), 0)
+    perms = dihedral_permutations() if window == 3 else None
+    return X, y, train, val, test, perms
+
+
+def _bench_train_rf(window):
+    def bench(sizes, workdir, workers):
+        from landcover.experiments import fit_rf
+        X, y, train, val, test, perms = _training_data(sizes, window)
+        rows = train.size * (len(perms) if perms is not None else 1)
+        with timing.stage(f'train_rf_{window}x{window}', items = rows,
+                          **RF_PARAMS[window]):
+            fit_rf(RF_PARAMS[window], X, y, train, val, test, 0, perms)
+    return bench
+
+
+def _bench_train_mlp(window):
+    def bench(sizes, workdir, workers):
+        name = f'train_mlp_{window}x{window}'
+        try:
+            import tensorflow  # noqa: F401
+        except ImportError:
+            timing.records.append({'stage' : name, 'skipped' : 'tensorflow not installed'})
+            return
+        from landcover.experiments import fit_mlp
+        X, y, train, val, test, perms = _training_data(sizes, window)
+        epochs = sizes['mlp_epochs']
+        rows = train.size * (len(perms) if perms is not None else 1) * epochs
+        params = {'layers' : list(MLP_LAYERS), 'epochs' : epochs}
+        with timing.stage(name, items = rows, epochs = epochs) as record:
+            fit_mlp(params, X, y, train, val, test, 0, perms)
+        # the real fits run 600 epochs
+        record['seconds_per_epoch'] = record['seconds'] / epochs
+    return bench
+
+
+def _bench_predict_rf(window):
+    def bench(sizes, workdir, workers):
+        from sklearn.ensemble import RandomForestClassifier
+        X, y, train, _, _, _ = _training_data(sizes, window)
+        model = RandomForestClassifier(random_state = 0, n_jobs = 1, **RF_PARAMS[window])
+        model.fit(X[train], y[train])
+        pixels = np.random.default_rng(1).integers(0, 10000, (sizes['pixels'], X.shape[1]),
+                                                   dtype = np.uint16)
+        with timing.stage(f'predict_rf_{window}x{window}', items = len(pixels)):
+            model.predict_proba(pixels)
+    return bench
+
+
+def _bench_predict_mlp(window):
+    def bench(sizes, workdir, workers):
+        from landcover.mlp import MLPRuntime
+        n_features = window * window * N_BANDS
+        path = random_mlp(os.path.join(workdir, 'mlp.npz'), n_features)
+        runtime = MLPRuntime.load(path, n_jobs = 1)
+        pixels = np.random.default_rng(1).integers(0, 10000, (sizes['pixels'], n_features),
+                                                   dtype = np.uint16)
+        with timing.stage(f'predict_mlp_{window}x{window}', items = len(pixels)):
+            runtime.predict(pixels)
+    return bench
+
+
+def _bench_precision_mlp(window):
+    def bench(sizes, workdir, workers):
+        from landcover.features import centre_pixel, flatten_patches
+        from landcover.mlp import compare_precisions
+        n_features = window * window * N_BANDS
+        path = random_mlp(os.path.join(workdir, 'mlp.npz'), n_features)
+        patches, _ = synthetic_patches(sizes['pixels'], seed = 1)
+        X = flatten_patches(patches)
+        if window == 1:
+            X = centre_pixel(X)
+        with timing.stage(f'precision_mlp_{window}x{window}', items = len(X)) as record:
+            report = compare_precisions(path, X, out_dir = workdir)
+        for precision, result in report.items():
+            record[f'{precision}_class_agreement'] = result['class_agreement']
+            record[f'{precision}_max_proba_delta'] = result['max_proba_delta']
+            record[f'{precision}_file_bytes'] = result['file_bytes']
+    return bench
+
+
+def _bench_classify(window):
+    def bench(sizes, workdir, workers):
+        from landcover.classification import classify_region, load_classifier
+        slice_path = synthetic_slice(os.path.join(workdir, 'slice.npy'), sizes['slice_side'])
+        model_path = random_mlp(os.path.join(workdir, 'mlp.npz'), window * window * N_BANDS)
+        classifier = load_classifier(model_path, window)
+        classify_region([slice_path], classifier, os.path.join(workdir, 'masks'),
+                        workers = workers)
+        # keep the benchmark name next to the pipeline's own record
+        timing.records[-1]['stage'] = f'classify_mlp_{window}x{window}'
+    return bench
+
+
+STAGES = {'extraction' : bench_extraction,
+          'flatten' : bench_flatten,
+          'train_rf_1x1' : _bench_train_rf(1),
+          'train_rf_3x3' : _bench_train_rf(3),
+          'train_mlp_1x1' : _bench_train_mlp(1),
+          'train_mlp_3x3' : _bench_train_mlp(3),
+          'predict_rf_1x1' : _bench_predict_rf(1),
+          'predict_rf_3x3' : _bench_predict_rf(3),
+          'predict_mlp_1x1' : _bench_predict_mlp(1),
+          'predict_mlp_3x3' : _bench_predict_mlp(3),
+          'precision_mlp_1x1' : _bench_precision_mlp(1),
+          'precision_mlp_3x3' : _bench_precision_mlp(3),
+          'classify_mlp_1x1' : _bench_classify(1),
+          'classify_mlp_3x3' : _bench_classify(3)}
+
+
+### RUNNER ####################################################################
+
+def _run_stage(name, sizes, workers):
+    # timing records of this (fresh) process only
+    os.environ.pop('LANDCOVER_TIMINGS', None)
+    with tempfile.TemporaryDirectory() as workdir:
+        STAGES[name](sizes, workdir, workers)
+    return timing.records
+
+
+def machine_info():
+    return {'python' : platform.python_version(),
+            'numpy' : np.__version__,
+            'platform' : platform.platform(),
+            'processor' : platform.processor() or platform.machine(),
+            'cpu_count' : os.cpu_count()}
+
+
+def run(stages = None, scale = 1.0, workers = None):
+    """Run ``stages`` (default: all) and return the benchmark report.
+
+    Problem sizes are the :data:`SIZES` multiplied by ``scale``. Stages that
+    fail are reported with their error instead of stopping the run.
+    """
+    stages = list(stages or STAGES)
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        raise ValueError(f'Unknown stages: {sorted(unknown)}')
+    workers = workers or os.cpu_count() or 1
+    sizes = {k : max(1, int(round(v * scale))) for k, v in SIZES.items()}
+    sizes['mlp_epochs'] = SIZES['mlp_epochs']
+
+    results = {}
+    context = multiprocessing.get_context('spawn')
+    for name in stages:
+        with ProcessPoolExecutor(max_workers = 1, mp_context = context) as pool:
+            try:
+                records = pool.submit(_run_stage, name, sizes, workers).result()
+            except Exception as error:
+                records = [{'stage' : name, 'error' : f'{type(error).__name__}: {error}'}]
+        for record in records:
+            results[record['stage']] = record
+    return {'time' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'machine' : machine_info(),
+            'scale' : scale,
+            'workers' : workers,
+            'sizes' : sizes,
+            'stages' : results}
+
+
+def save(report, out_dir):
+    os.makedirs(out_dir, exist_ok = True)
+    name = report['time'].replace(':', '').replace('-', '') + '.json'
+    path = os.path.join(out_dir, name)
+    with open(path, 'w') as f:
+        json.dump(report, f, indent = 1)
+    return path
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def latest(out_dir):
+    """Path of the most recent report in ``out_dir``, or None."""
+    paths = sorted(glob.glob(os.path.join(out_dir, '*.json')))
+    return paths[-1] if paths else None
+
+
+def compare(old, new, tolerance = 0.1):
+    """Stage-by-stage comparison of two reports.
+
+    A stage regresses when its throughput (items per second, or 1 / seconds
+    when it has no item count) falls, or its peak memory grows, by more than
+    ``tolerance``. Only stages timed in both reports are compared.
+    """
+    rows = []
+    for name, after in new['stages'].items():
+        before = old['stages'].get(name)
+        if not before or 'seconds' not in before or 'seconds' not in after:
+            continue
+        if before.get('items_per_second') and after.get('items_per_second'):
+            speed = after['items_per_second'] / before['items_per_second']
+        else:
+            speed = before['seconds'] / after['seconds']
+        memory = after['peak_rss_mb'] / before['peak_rss_mb']
+        rows.append({'stage' : name,
+                     'seconds_before' : before['seconds'],
+                     'seconds_after' : after['seconds'],
+                     'speed_ratio' : speed,
+                     'memory_ratio' : memory,
+                     'regression' : speed < 1 - tolerance or memory > 1 + tolerance})
+    return rows
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__.split('\n\n')[0])
+    parser.add_argument('--out', default = 'benchmarks',
+                        help = 'directory of the JSON reports')
+    parser.add_argument('--stages', nargs = '+', choices = sorted(STAGES),
+                        help = 'stages to run (default: all)')
+    parser.add_argument('--scale', type = float, default = 1.0,
+                        help = 'multiplier of the problem sizes')
+    parser.add_argument('--workers', type = int, help = 'processes for classification')
+    parser.add_argument('--compare', metavar = 'REPORT',
+                        help = 'earlier report to check for regressions')
+    parser.add_argument('--tolerance', type = float, default = 0.1)
+    args = parser.parse_args(argv)
+
+    report = run(args.stages, args.scale, args.workers)
+    path = save(report, args.out)
+    for name, record in report['stages'].items():
+        if 'seconds' in record:
+            speed = record.get('items_per_second')
+            print(f'{name:28s} {record["seconds"]:9.2f} s'
+                  + (f' {speed:14,.0f} items/s' if speed else ' ' * 23)
+                  + f' {record["peak_rss_mb"]:9.0f} MB')
+        else:
+            print(f'{name:28s} {record.get("skipped") or record.get("error")}')
+    print(f'saved {path}')
+
+    if args.compare:
+        regressions = 0
+        for row in compare(load(args.compare), report, args.tolerance):
+            flag = 'REGRESSION' if row['regression'] else ''
+            regressions += row['regression']
+            print(f'{row["stage"]:28s} speed x{row["speed_ratio"]:.2f} '
+                  f'memory x{row["memory_ratio"]:.2f} {flag}')
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,413 @@
+"""Tiled, multi-process classification of regional reflectance slices.
+
+A region (e.g. Lazio) is exported from Earth Engine as square slices in
+which out-of-area pixels have every band equal to zero. Each slice is read
+lazily, either as a GeoTIFF (bands first, needs ``rasterio``) or as a
+``.npy`` array of shape (rows, cols, 12) opened memory-mapped, and is cut
+into tiles that are classified by a pool of worker processes. Results are
+written into the output mask tile by tile, so memory use depends on the tile
+size and the number of workers, never on the size of the region.
+
+3x3 classifiers read each tile with a one pixel halo taken from the
+neighbouring tiles. Only at the border of a slice is the halo filled with
+edge values, which gives the same features as edge-padding the whole slice
+without ever building the padded copy.
+
+Mask values are 0 for out-of-area pixels and 1..8 for classes A..H.
+"""
+
+import json
+import os
+import pickle
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+
+from landcover import CLASS_CODES, N_BANDS, timing
+from landcover.features import iter_feature_batches
+from landcover.statistics import RegionRaster, tile_counts
+
+
+### SOURCES ###################################################################
+
+class SliceSource:
+    """Lazy, windowed reader over one exported reflectance slice."""
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._array = None
+        self._dataset = None
+        if self.path.endswith('.npy'):
+            self._array = np.load(self.path, mmap_mode = 'r')
+            if self._array.ndim != 3 or self._array.shape[2] != N_BANDS:
+                raise ValueError(f'{self.path}: expected (rows, cols, {N_BANDS}) '
+                                 f'array, got shape {self._array.shape}')
+            self.shape = self._array.shape[:2]
+        elif self.path.endswith(('.tif', '.tiff')):
+            import rasterio
+            self._dataset = rasterio.open(self.path)
+            if self._dataset.count != N_BANDS:
+                raise ValueError(f'{self.path}: expected {N_BANDS} bands, '
+                                 f'got {self._dataset.count}')
+            self.shape = (self._dataset.height, self._dataset.width)
+        else:
+            raise ValueError(f'Unsupported slice format: {self.path}')
+
+    def _read(self, r0, r1, c0, c1):
+        if self._array is not None:
+            return self._array[r0:r1, c0:c1, :]
+        from rasterio.windows import Window
+        block = self._dataset.read(window = Window(c0, r0, c1 - c0, r1 - r0))
+        return block.transpose(1, 2, 0)
+
+    def read_block(self, r0, r1, c0, c1, halo = 0):
+        """Return pixels [r0:r1, c0:c1] plus ``halo`` pixels on every side.
+
+        The halo is read from the slice where it exists and edge-padded
+        where it falls outside of it.
+        """
+        rows, cols = self.shape
+        rr0, rr1 = max(r0 - halo, 0), min(r1 + halo, rows)
+        cc0, cc1 = max(c0 - halo, 0), min(c1 + halo, cols)
+        block = np.asarray(self._read(rr0, rr1, cc0, cc1), dtype = np.uint16)
+        pad = ((rr0 - (r0 - halo), (r1 + halo) - rr1),
+               (cc0 - (c0 - halo), (c1 + halo) - cc1),
+               (0, 0))
+        if any(p for pair in pad for p in pair):
+            block = np.pad(block, pad, mode = 'edge')
+        return block
+
+    def georeference(self):
+        """Bounds/CRS information to carry over to the output mask, if any."""
+        if self._dataset is not None:
+            return {'crs' : str(self._dataset.crs),
+                    'transform' : list(self._dataset.transform)[:6],
+                    'bounds' : list(self._dataset.bounds)}
+        sidecar = os.path.splitext(self.path)[0] + '.json'
+        if os.path.exists(sidecar):
+            with open(sidecar) as f:
+                return json.load(f)
+        return None
+
+    def close(self):
+        if self._dataset is not None:
+            self._dataset.close()
+
+
+### CLASSIFIERS ###############################################################
+
+def _mask_values(classes):
+    """Map model class labels (letters A..H or integers 0..7) to mask values."""
+    values = []
+    for c in classes:
+        if isinstance(c, (str, np.str_)):
+            values.append(CLASS_CODES.index(str(c)[0]) + 1)
+        else:
+            values.append(int(c) + 1)
+    return np.asarray(values, dtype = np.uint8)
+
+
+class Classifier:
+    """Base class for models applied by the engine.
+
+    Subclasses keep only the model path in their pickled state and load the
+    model lazily, so a classifier is cheap to ship to worker processes.
+    ``window`` is 1 for 1x1 models (12 features per pixel) and 3 for 3x3
+    models (108 features per pixel).
+    """
+
+    def __init__(self, path, window = 1):
+        if window not in (1, 3):
+            raise ValueError(f'window must be 1 or 3, got {window}')
+        self.path = str(path)
+        self.window = window
+        self._model = None
+
+    @property
+    def n_features(self):
+        return self.window * self.window * N_BANDS
+
+    @property
+    def model(self):
+        if self._model is None:
+            self._model = self.load()
+        return self._model
+
+    def load(self):
+        raise NotImplementedError
+
+    def predict(self, X):
+        """Return mask values (1..8) for a (n, n_features) uint16 matrix."""
+        raise NotImplementedError
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_model'] = None
+        return state
+
+
+class SklearnClassifier(Classifier):
+    """Pickled scikit-learn model (RF 1x1 / RF 3x3)."""
+
+    def load(self):
+        with open(self.path, 'rb') as f:
+            model = pickle.load(f)
+        if hasattr(model, 'n_jobs'):
+            # the engine already runs one process per core; a model trained
+            # with n_jobs = -1 would start cpu_count threads in each of them
+            model.n_jobs = 1
+        self._lookup = _mask_values(model.classes_)
+        return model
+
+    def predict(self, X):
+        model = self.model
+        return self._lookup[np.argmax(model.predict_proba(X), axis = 1)]
+
+
+class KerasClassifier(Classifier):
+    """Saved Keras model (MLP 1x1 / MLP 3x3) with 8 softmax outputs A..H."""
+
+    def load(self):
+        from tensorflow import keras
+        return keras.models.load_model(self.path)
+
+    def predict(self, X):
+        proba = self.model.predict(X.astype(np.float32), verbose = 0)
+        return np.argmax(proba, axis = 1).astype(np.uint8) + 1
+
+
+class MLPRuntimeClassifier(Classifier):
+    """MLP exported with :func:`landcover.mlp.export_keras` (no TensorFlow)."""
+
+    def load(self):
+        from landcover.mlp import MLPRuntime
+        # the engine already runs one process per core
+        return MLPRuntime.load(self.path, n_jobs = 1)
+
+    def predict(self, X):
+        return self.model.predict(X).astype(np.uint8) + 1
+
+
+CLASSIFIER_FORMATS = {'.pkl' : SklearnClassifier,
+                      '.pickle' : SklearnClassifier,
+                      '.h5' : KerasClassifier,
+                      '.keras' : KerasClassifier}
+
+# .npz files hold exported models, told apart by their 'kind' entry
+NPZ_FORMATS = {'mlp' : MLPRuntimeClassifier}
+
+
+def load_classifier(path, window = 1):
+    """Pick the classifier wrapper for a saved model from its extension."""
+    path = str(path)
+    ext = os.path.splitext(path)[1].lower()
+    if ext in CLASSIFIER_FORMATS:
+        return CLASSIFIER_FORMATS[ext](path, window)
+    if ext == '.npz':
+        with np.load(path, allow_pickle = False) as f:
+            kind = str(f['kind'])
+        if kind not in NPZ_FORMATS:
+            raise ValueError(f'{path}: no map classifier for exported {kind!r} models')
+        return NPZ_FORMATS[kind](path, window)
+    if os.path.isdir(path):
+        # Keras SavedModel directory
+        return KerasClassifier(path, window)
+    raise ValueError(f'Unknown model format: {path}')
+
+
+### WORKERS ###################################################################
+
+_worker = {}
+
+
+def _init_worker(classifier, batch_size, regions = None, n_regions = 0):
+    _worker['classifier'] = classifier
+    _worker['batch_size'] = batch_size
+    _worker['sources'] = {}
+    _worker['regions'] = regions or {}
+    _worker['n_regions'] = n_regions
+    _worker['region_rasters'] = {}
+
+
+def _region_counts(path, r0, r1, c0, c1, mask):
+    """Per-region class counts of a classified tile, if the slice has regions."""
+    if path not in _worker['regions']:
+        return None
+    rasters = _worker['region_rasters']
+    if path not in rasters:
+        rasters[path] = RegionRaster(_worker['regions'][path])
+    return tile_counts(rasters[path].read(r0, r1, c0, c1), mask, _worker['n_regions'],
+                       name = f'{rasters[path].path} (regions of {path})')
+
+
+def _classify_tile(path, r0, r1, c0, c1):
+    classifier = _worker['classifier']
+    sources = _worker['sources']
+    if path not in sources:
+        sources[path] = SliceSource(path)
+    source = sources[path]
+
+    halo = classifier.window // 2
+    block = source.read_block(r0, r1, c0, c1, halo)
+    core = block[halo:block.shape[0] - halo, halo:block.shape[1] - halo]
+    valid = core.any(axis = 2)
+    if not valid.any():
+        # out-of-area block: nothing to predict or send back
+        return path, r0, c0, None, None
+    mask = np.zeros(valid.shape, dtype = np.uint8)
+    for rows, cols, X in iter_feature_batches(block, classifier.window, valid,
+                                              _worker['batch_size']):
+        mask[rows, cols] = classifier.predict(X)
+    return path, r0, c0, mask, _region_counts(path, r0, r1, c0, c1, mask)
+
+
+### WRITERS ###################################################################
+
+class MaskWriter:
+    """Incrementally written uint8 class mask (.npy memmap or GeoTIFF)."""
+
+    def __init__(self, path, source):
+        self.path = str(path)
+        self._array = None
+        self._dataset = None
+        rows, cols = source.shape
+        if self.path.endswith('.npy'):
+            self._array = np.lib.format.open_memmap(
+                self.path, mode = 'w+', dtype = np.uint8, shape = (rows, cols))
+            georef = source.georeference()
+            if georef is not None:
+                with open(os.path.splitext(self.path)[0] + '.json', 'w') as f:
+                    json.dump(georef, f)
+        elif self.path.endswith(('.tif', '.tiff')):
+            import rasterio
+            profile = self._profile(source)
+            profile.update(count = 1, dtype = 'uint8', nodata = 0,
+                           compress = 'deflate', tiled = True)
+            self._dataset = rasterio.open(self.path, 'w', **profile)
+        else:
+            raise ValueError(f'Unsupported mask format: {self.path}')
+
+    @staticmethod
+    def _profile(source):
+        """GeoTIFF profile of the mask: the slice's own, or built from its sidecar."""
+        if source._dataset is not None:
+            return source._dataset.profile.copy()
+        from rasterio.transform import Affine, from_bounds
+        georef = source.georeference()
+        rows, cols = source.shape
+        if georef and 'transform' in georef:
+            transform = Affine(*georef['transform'][:6])
+        elif georef and 'bounds' in georef:
+            transform = from_bounds(*georef['bounds'], cols, rows)
+        else:
+            raise ValueError(f'{source.path}: a GeoTIFF mask needs a georeferenced slice '
+                             '(a GeoTIFF, or a .json sidecar with transform or bounds)')
+        return {'driver' : 'GTiff', 'height' : rows, 'width' : cols,
+                'crs' : georef.get('crs', 'EPSG:4326'), 'transform' : transform}
+
+    def write(self, r0, c0, mask):
+        r1, c1 = r0 + mask.shape[0], c0 + mask.shape[1]
+        if self._array is not None:
+            self._array[r0:r1, c0:c1] = mask
+        else:
+            from rasterio.windows import Window
+            self._dataset.write(mask, 1, window = Window(c0, r0, c1 - c0, r1 - r0))
+
+    def close(self):
+        if self._array is not None:
+            self._array.flush()
+            del self._array
+            self._array = None
+        if self._dataset is not None:
+            self._dataset.close()
+
+
+### ENGINE ####################################################################
+
+def iter_tiles(shape, tile_size):
+    rows, cols = shape
+    for r0 in range(0, rows, tile_size):
+        for c0 in range(0, cols, tile_size):
+            yield r0, min(r0 + tile_size, rows), c0, min(c0 + tile_size, cols)
+
+
+def _mask_path(slice_path, out_dir, suffix):
+    name = os.path.splitext(os.path.basename(str(slice_path)))[0]
+    return os.path.join(out_dir, name + '_mask' + suffix)
+
+
+def classify_region(slices, classifier, out_dir, tile_size = 256,
+                    workers = None, suffix = '.npy', batch_size = 65536,
+                    regions = None, histogram = None):
+    """Classify every slice of a region and write one mask per slice.
+
+    Tiles from all slices share a single process pool. At most
+    ``2 * workers`` tiles are in flight at once, which bounds memory use
+    regardless of the region size; within a tile, features are built and
+    predicted ``batch_size`` pixels at a time. Tiles whose pixels are all zero
+    (entirely out of the region) are skipped by the worker without running
+    the model or sending a mask back.
+
+    ``regions`` maps slice paths to region-ID rasters of the same shape
+    (see :mod:`landcover.statistics`); the per-region class counts of every
+    classified tile are then added to ``histogram``, a
+    :class:`~landcover.statistics.RegionHistogram`, during the same pass.
+
+    Returns the list of written mask paths, in the order of ``slices``.
+    """
+    workers = workers or os.cpu_count() or 1
+    os.makedirs(out_dir, exist_ok = True)
+    if regions and histogram is None:
+        raise ValueError('regions given without a histogram to fill')
+    regions = {str(k) : str(v) for k, v in (regions or {}).items()}
+    n_regions = histogram.n_regions if histogram is not None else 0
+
+    names = {}
+    for p in slices:
+        mask_path = _mask_path(p, out_dir, suffix)
+        if mask_path in names:
+            raise ValueError(f'{names[mask_path]} and {p} would both write {mask_path}: '
+                             'slices need distinct file names')
+        names[mask_path] = p
+
+    sources = {str(p) : SliceSource(p) for p in slices}
+    writers = {p : MaskWriter(_mask_path(p, out_dir, suffix), s)
+               for p, s in sources.items()}
+
+    def tasks():
+        for path, source in sources.items():
+            for r0, r1, c0, c1 in iter_tiles(source.shape, tile_size):
+                yield path, r0, r1, c0, c1
+
+    def collect(futures):
+        for future in futures:
+            path, r0, c0, mask, counts = future.result()
+            # out-of-area blocks stay zero in the zero-initialised mask
+            if mask is not None:
+                writers[path].write(r0, c0, mask)
+            if counts is not None:
+                histogram.add(counts)
+
+    pixels = sum(s.shape[0] * s.shape[1] for s in sources.values())
+    with timing.stage('classify_region', items = pixels,
+                      model = os.path.basename(classifier.path),
+                      window = classifier.window, workers = workers):
+        try:
+            with ProcessPoolExecutor(max_workers = workers,
+                                     initializer = _init_worker,
+                                     initargs = (classifier, batch_size,
+                                                 regions, n_regions)) as pool:
+                pending = set()
+                for task in tasks():
+                    if len(pending) >= 2 * workers:
+                        done, pending = wait(pending, return_when = FIRST_COMPLETED)
+                        collect(done)
+                    pending.add(pool.submit(_classify_tile, *task))
+                collect(wait(pending).done)
+        finally:
+            for writer in writers.values():
+                writer.close()
+            for source in sources.values():
+                source.close()
+
+    return [writers[str(p)].path for p in slices]
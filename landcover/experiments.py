@@ -0,0 +1,347 @@
+"""Parallel tuning and stability experiments for the RF and MLP classifiers.
+
+The Algorithms training page follows two steps for each of RF 1x1, RF 3x3,
+MLP 1x1 and MLP 3x3:
+
+1. tuning: a grid of model structures is fitted on one random 60/20/20
+   train/validation/test split and the best validation score wins
+   (accuracy for RF, lowest loss for MLP);
+2. stability: the chosen structure is refitted on ten new random splits and
+   the mean and standard deviation of the test confusion matrices are
+   reported.
+
+Every fit is an :class:`Experiment` and :func:`run` schedules them on a
+process pool. Workers open the dataset as a :class:`~landcover.store.LucasStore`,
+so they all read one shared page-cache copy of it. Results are cached as
+JSON keyed by (algorithm, window, parameters, seed, dataset size and a
+:func:`store_fingerprint`), so rerunning a sweep only fits the new cells
+and a rebuilt store invalidates them.
+
+3x3 training sets are augmented with the eight flips/rotations of each
+patch. A flip or rotation of a flattened 3x3x12 row is only a permutation
+of its 108 columns (:func:`dihedral_permutations`), so augmented batches
+are gathered on the fly rather than stored 8x larger. The MLP sees them
+batch by batch. The random forest needs its whole training matrix at fit
+time, so the worker builds it only for the duration of that fit.
+"""
+
+import hashlib
+import json
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import product
+
+import numpy as np
+
+from landcover import CLASS_CODES, N_BANDS, timing
+
+
+N_CLASSES = len(CLASS_CODES)
+
+
+### AUGMENTATION ##############################################################
+
+def dihedral_permutations(size = 3, bands = N_BANDS):
+    """Column permutations of a flattened (size, size, bands) row.
+
+    Returns an (8, size * size * bands) array; ``row[:, perms[k]]`` is the
+    k-th rotation/flip of the patch (k = 0 is the identity).
+    """
+    grid = np.arange(size * size * bands).reshape(size, size, bands)
+    perms = []
+    for k in range(4):
+        rotated = np.rot90(grid, k, axes = (0, 1))
+        perms.append(rotated.ravel())
+        perms.append(rotated[:, ::-1].ravel())
+    return np.stack(perms)
+
+
+class AugmentedBatches:
+    """Training batches with every patch expanded by all of ``perms``.
+
+    ``batch_size`` counts augmented rows, so each batch draws
+    ``batch_size // len(perms)`` patches of ``index`` and gathers their
+    permuted columns; nothing larger than one batch is ever built.
+    :meth:`shuffle` draws a new patch order (call it between epochs).
+    """
+
+    def __init__(self, X, y, index, batch_size, perms, rng):
+        self.X, self.y, self.perms, self.rng = X, y, perms, rng
+        self.index = np.asarray(index)
+        self.per_batch = max(1, batch_size // len(perms))
+        self.shuffle()
+
+    def shuffle(self):
+        self.order = self.rng.permutation(self.index)
+
+    def __len__(self):
+        return int(np.ceil(self.index.size / self.per_batch))
+
+    def __getitem__(self, i):
+        rows = np.sort(self.order[i * self.per_batch:(i + 1) * self.per_batch])
+        Xb = np.asarray(self.X[rows])
+        return (np.concatenate([Xb[:, p] for p in self.perms]),
+                np.tile(np.asarray(self.y[rows]), len(self.perms)))
+
+
+### SPLITS AND SCORES #########################################################
+
+def split_indices(n, seed, fractions = (0.6, 0.2, 0.2)):
+    """Random train/validation/test indices."""
+    order = np.random.default_rng(seed).permutation(n)
+    n_train = int(round(fractions[0] * n))
+    n_val = int(round(fractions[1] * n))
+    return (np.sort(order[:n_train]), np.sort(order[n_train:n_train + n_val]),
+            np.sort(order[n_train + n_val:]))
+
+
+def confusion_matrix(y_true, y_pred, n_classes = N_CLASSES):
+    """Counts with true classes on rows and predicted classes on columns."""
+    return np.bincount(np.asarray(y_true) * n_classes + np.asarray(y_pred),
+                       minlength = n_classes * n_classes).reshape(n_classes, n_classes)
+
+
+def normalise_rows(matrix):
+    """Row-normalised confusion matrix (diagonal = per-class recall)."""
+    matrix = np.asarray(matrix, dtype = np.float64)
+    totals = matrix.sum(axis = 1, keepdims = True)
+    totals[totals == 0] = 1
+    return matrix / totals
+
+
+### FITS ######################################################################
+
+def _features(store, window):
+    return store.rows_3x3 if window == 3 else store.rows_1x1
+
+
+def fit_rf(params, X, y, train, val, test, seed, perms):
+    from sklearn.ensemble import RandomForestClassifier
+    if perms is not None:
+        # sklearn needs the full matrix: build it for this fit only
+        Xt = np.asarray(X[train])
+        Xtrain = np.concatenate([Xt[:, p] for p in perms])
+        ytrain = np.tile(np.asarray(y[train]), len(perms))
+    else:
+        Xtrain, ytrain = np.asarray(X[train]), np.asarray(y[train])
+    model = RandomForestClassifier(n_estimators = params['n_estimators'],
+                                   max_samples = params['max_samples'],
+                                   max_features = params['max_features'],
+                                   random_state = seed, n_jobs = 1)
+    model.fit(Xtrain, ytrain)
+    val_pred = model.predict(np.asarray(X[val]))
+    val_accuracy = float(np.mean(val_pred == np.asarray(y[val])))
+    return {'score' : val_accuracy,
+            'val_accuracy' : val_accuracy,
+            'val_pred' : val_pred,
+            'test_pred' : model.predict(np.asarray(X[test]))}
+
+
+def fit_mlp(params, X, y, train, val, test, seed, perms):
+    from tensorflow import keras
+
+    keras.utils.set_random_seed(seed)
+    regularizer = keras.regularizers.L1L2(l1 = params.get('l1', 0.01), l2 = params.get('l2', 0.01))
+    model = keras.Sequential([keras.Input(shape = (X.shape[1],)),
+                              keras.layers.Rescaling(1.0 / 10000)])
+    for units in params.get('layers', [128, 64, 32]):
+        model.add(keras.layers.Dense(units, activation = 'relu',
+                                     kernel_regularizer = regularizer))
+    if params.get('dropout', 0.5):
+        model.add(keras.layers.Dropout(params.get('dropout', 0.5)))
+    model.add(keras.layers.Dense(N_CLASSES, activation = 'softmax'))
+    model.compile(optimizer = 'adam', loss = 'sparse_categorical_crossentropy',
+                  metrics = ['accuracy'])
+
+    if perms is None:
+        perms = np.arange(X.shape[1])[None, :]
+    batches = AugmentedBatches(X, y, train, params.get('batch_size', 300), perms,
+                               np.random.default_rng(seed))
+
+    class Sequence(keras.utils.Sequence):
+        def __len__(self):
+            return len(batches)
+
+        def __getitem__(self, i):
+            Xb, yb = batches[i]
+            return Xb.astype(np.float32), yb
+
+        def on_epoch_end(self):
+            batches.shuffle()
+
+    Xval, yval = np.asarray(X[val], dtype = np.float32), np.asarray(y[val])
+
+    class KeepBest(keras.callbacks.Callback):
+        # the epochs surely overfit: keep the weights of the lowest val loss
+        best, weights = np.inf, None
+
+        def on_epoch_end(self, epoch, logs = None):
+            if logs['val_loss'] < self.best:
+                self.best, self.weights = logs['val_loss'], self.model.get_weights()
+
+    keep = KeepBest()
+    history = model.fit(Sequence(), validation_data = (Xval, yval),
+                        epochs = params.get('epochs', 600), callbacks = [keep],
+                        verbose = 0)
+    model.set_weights(keep.weights)
+    val_loss = float(np.min(history.history['val_loss']))
+    val_pred = np.argmax(model.predict(Xval, verbose = 0), axis = 1)
+    test_pred = np.argmax(model.predict(np.asarray(X[test], dtype = np.float32),
+                                        verbose = 0), axis = 1)
+    return {'score' : -val_loss,
+            'val_loss' : val_loss,
+            'val_accuracy' : float(np.mean(val_pred == yval)),
+            'val_pred' : val_pred,
+            'test_pred' : test_pred}
+
+
+FITS = {'rf' : fit_rf, 'mlp' : fit_mlp}
+
+
+### EXPERIMENTS ###############################################################
+
+# ``augment`` defaults to flips/rotations for 3x3 data only
+Experiment = namedtuple('Experiment', ['algorithm', 'window', 'params', 'seed', 'augment'],
+                        defaults = [None])
+
+
+def _augment(experiment):
+    return experiment.window == 3 if experiment.augment is None else experiment.augment
+
+
+def store_fingerprint(store_path):
+    """Short hash of a store's ``meta.json`` and of the size and mtime of its labels.
+
+    Rebuilding or relabelling the store changes it, so cached results from
+    another version of the data are not reused.
+    """
+    digest = hashlib.sha1()
+    with open(os.path.join(store_path, 'meta.json'), 'rb') as f:
+        digest.update(f.read())
+    labels = os.stat(os.path.join(store_path, 'lc1.npy'))
+    digest.update(f'{labels.st_size}:{labels.st_mtime_ns}'.encode())
+    return digest.hexdigest()[:16]
+
+
+def cache_key(experiment, n_rows, fingerprint):
+    config = {'algorithm' : experiment.algorithm, 'window' : experiment.window,
+              'params' : experiment.params, 'seed' : experiment.seed,
+              'augment' : _augment(experiment), 'n_rows' : n_rows,
+              'store' : fingerprint}
+    text = json.dumps(config, sort_keys = True)
+    return hashlib.sha1(text.encode()).hexdigest()[:16], config
+
+
+_worker = {}
+
+
+def _init_worker(store_path):
+    from landcover.store import LucasStore
+    _worker['store'] = LucasStore.open(store_path)
+    _worker['perms'] = dihedral_permutations()
+
+
+def _run_experiment(experiment):
+    store = _worker['store']
+    X = _features(store, experiment.window)
+    y = store.lc1
+    train, val, test = split_indices(len(store), experiment.seed)
+    perms = _worker['perms'] if _augment(experiment) else None
+
+    start = time.perf_counter()
+    fitted = FITS[experiment.algorithm](experiment.params, X, y, train, val, test,
+                                        experiment.seed, perms)
+    seconds = time.perf_counter() - start
+
+    y = np.asarray(y)
+    test_confusion = confusion_matrix(y[test], fitted.pop('test_pred'))
+    val_confusion = confusion_matrix(y[val], fitted.pop('val_pred'))
+    fitted.update({'fit_seconds' : seconds,
+                   'test_accuracy' : float(np.trace(test_confusion) / test.size),
+                   'val_confusion' : val_confusion.tolist(),
+                   'test_confusion' : test_confusion.tolist()})
+    return fitted
+
+
+def run(experiments, store_path, cache_dir, workers = None):
+    """Fit every experiment not in ``cache_dir`` and return all results.
+
+    Results are dicts with the experiment ``config``, its validation
+    ``score`` (higher is better), accuracies and confusion matrices, in the
+    order of ``experiments``. If some fits fail, the others are still
+    cached and a ``RuntimeError`` listing the failed configs is raised at the
+    end; rerunning only fits the missing cells.
+    """
+    from landcover.store import LucasStore
+    os.makedirs(cache_dir, exist_ok = True)
+    n_rows = len(LucasStore.open(store_path))
+    fingerprint = store_fingerprint(store_path)
+
+    results, missing = {}, []
+    for experiment in experiments:
+        key, config = cache_key(experiment, n_rows, fingerprint)
+        path = os.path.join(cache_dir, key + '.json')
+        if os.path.exists(path):
+            with open(path) as f:
+                results[key] = json.load(f)
+        elif key not in [k for k, _, _ in missing]:
+            missing.append((key, config, experiment))
+
+    if missing:
+        with timing.stage('experiments', items = len(missing)), \
+                ProcessPoolExecutor(max_workers = workers or os.cpu_count() or 1,
+                                    initializer = _init_worker,
+                                    initargs = (store_path,)) as pool:
+            futures = {pool.submit(_run_experiment, experiment) : (key, config)
+                       for key, config, experiment in missing}
+            # cache every fit as soon as it ends, so a failing cell does not
+            # throw away the rest of the sweep
+            failures = []
+            for future in as_completed(futures):
+                key, config = futures[future]
+                try:
+                    result = future.result()
+                except Exception as error:
+                    failures.append((config, error))
+                    continue
+                result['config'] = config
+                with open(os.path.join(cache_dir, key + '.json'), 'w') as f:
+                    json.dump(result, f)
+                results[key] = result
+        if failures:
+            details = '; '.join(f'{config}: {type(error).__name__}: {error}'
+                                for config, error in failures)
+            raise RuntimeError(f'{len(failures)} of {len(missing)} experiments failed '
+                               f'(the others are cached): {details}') from failures[0][1]
+
+    return [results[cache_key(e, n_rows, fingerprint)[0]] for e in experiments]
+
+
+def grid(algorithm, window, seed = 0, **param_lists):
+    """Tuning experiments for every combination of ``param_lists``."""
+    names = sorted(param_lists)
+    return [Experiment(algorithm, window, dict(zip(names, values)), seed)
+            for values in product(*(param_lists[n] for n in names))]
+
+
+def trials(algorithm, window, params, n = 10, first_seed = 1):
+    """Stability experiments: the same structure on ``n`` random splits."""
+    return [Experiment(algorithm, window, params, first_seed + i) for i in range(n)]
+
+
+def best(results):
+    """Result with the best validation score."""
+    return max(results, key = lambda r: r['score'])
+
+
+def stability(results):
+    """Mean and std of the row-normalised test confusion matrices."""
+    matrices = np.stack([normalise_rows(r['test_confusion']) for r in results])
+    accuracies = np.array([r['test_accuracy'] for r in results])
+    return {'trials' : len(results),
+            'mean_confusion' : matrices.mean(axis = 0),
+            'std_confusion' : matrices.std(axis = 0),
+            'mean_accuracy' : float(accuracies.mean()),
+            'std_accuracy' : float(accuracies.std())}
@@ -0,0 +1,65 @@
+"""Feature rows for the 1x1 and 3x3 classifiers.
+
+Training flattens every downloaded (3, 3, 12) image into one row of 108
+reflectances, pixel-major with the 12 bands varying fastest (column
+``(row * 3 + col) * 12 + band``); the 1x1 models use the 12 bands of the
+centre pixel. Inference over a raster must produce exactly the same columns
+for every pixel's neighbourhood.
+
+Instead of striding over the raster pixel by pixel, :func:`neighbourhood_view`
+exposes all neighbourhoods of a band cube as one strided view (no copy), and
+:func:`iter_feature_batches` gathers fixed-size batches of rows from it, so
+the 9x larger feature matrix of a 3x3 model is never built in full.
+"""
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from landcover import N_BANDS
+
+
+CENTRE_COLUMNS = slice(4 * N_BANDS, 5 * N_BANDS)
+
+
+def flatten_patches(patches):
+    """Training flatten: (n, 3, 3, 12) patches to (n, 108) rows."""
+    patches = np.asarray(patches)
+    return patches.reshape(patches.shape[0], -1)
+
+
+def centre_pixel(rows):
+    """1x1 features (12 bands of the centre pixel) from flattened 3x3 rows."""
+    return rows[:, CENTRE_COLUMNS]
+
+
+def neighbourhood_view(block, window):
+    """All ``window`` x ``window`` neighbourhoods of ``block`` as a view.
+
+    ``block`` is a (rows, cols, bands) cube carrying a halo of
+    ``window // 2`` pixels on every side. The result has shape
+    (rows - 2 * halo, cols - 2 * halo, window, window, bands) and shares
+    memory with ``block``; ``view[r, c].ravel()`` is the training row of the
+    pixel at (r, c).
+    """
+    view = sliding_window_view(block, (window, window), axis = (0, 1))
+    # sliding_window_view appends the window axes after the band axis
+    return view.transpose(0, 1, 3, 4, 2)
+
+
+def iter_feature_batches(block, window, valid = None, batch_size = 65536):
+    """Yield ``(rows, cols, X)`` for at most ``batch_size`` pixels at a time.
+
+    ``rows``/``cols`` index the pixels of the block core (without halo) and
+    ``X`` is their (n, window * window * bands) feature matrix, ready to be
+    passed to a classifier. Pixels where ``valid`` is False are left out.
+    """
+    view = neighbourhood_view(block, window)
+    if valid is None:
+        valid = np.ones(view.shape[:2], dtype = bool)
+    rows, cols = np.nonzero(valid)
+    n_features = window * window * block.shape[2]
+    for start in range(0, rows.size, batch_size):
+        r = rows[start:start + batch_size]
+        c = cols[start:start + batch_size]
+        # gathering from the view copies only this batch, already contiguous
+        yield r, c, view[r, c].reshape(r.size, n_features)
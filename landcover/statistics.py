@@ -0,0 +1,198 @@
+"""Streaming regional land-cover statistics and comparison with Lucas.
+
+The Map classification page compares the class shares of each classified
+map with the Lucas land-cover statistics of the region through the
+Kullback-Leibler divergence. Building one map per region made this too
+expensive for more than Lazio. Here each slice comes with a region-ID raster
+of the same shape: 0 outside every region, ``i`` for the i-th entry of a list
+of NUTS codes. While :func:`landcover.classification.classify_region` runs,
+every worker bincounts its tile's (region, class) pairs, and the
+:class:`RegionHistogram` adds them up. A single pass over the slices fills
+the class histogram of every region they touch.
+
+KL divergences are computed as D(Lucas || classifier), i.e. how far the
+classifier's distribution is from the Lucas one.
+"""
+
+import csv
+import json
+import os
+
+import numpy as np
+
+from landcover import CLASS_CODES, CLASS_NAMES
+
+
+# mask values: 0 out-of-area, then A..H
+N_MASK_VALUES = len(CLASS_CODES) + 1
+
+
+### REGION RASTERS ############################################################
+
+class RegionRaster:
+    """Lazy reader over a region-ID raster (.npy memmap or one-band GeoTIFF)."""
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._array = None
+        self._dataset = None
+        if self.path.endswith('.npy'):
+            self._array = np.load(self.path, mmap_mode = 'r')
+        elif self.path.endswith(('.tif', '.tiff')):
+            import rasterio
+            self._dataset = rasterio.open(self.path)
+        else:
+            raise ValueError(f'Unsupported region raster format: {self.path}')
+
+    def read(self, r0, r1, c0, c1):
+        if self._array is not None:
+            return np.asarray(self._array[r0:r1, c0:c1])
+        from rasterio.windows import Window
+        return self._dataset.read(1, window = Window(c0, r0, c1 - c0, r1 - r0))
+
+    def close(self):
+        if self._dataset is not None:
+            self._dataset.close()
+
+
+def rasterize_regions(geojson_path, slice_path, out_path, code_property = 'NUTS_ID'):
+    """Burn NUTS polygons into a region-ID GeoTIFF aligned with a slice.
+
+    Returns the list of region codes; the region with ID ``i`` is
+    ``codes[i - 1]``. Needs ``rasterio``.
+    """
+    import rasterio
+    from rasterio.features import rasterize
+
+    with open(geojson_path) as f:
+        features = json.load(f)['features']
+    codes = [feature['properties'][code_property] for feature in features]
+    with rasterio.open(slice_path) as src:
+        profile = src.profile.copy()
+        shapes = [(feature['geometry'], i + 1) for i, feature in enumerate(features)]
+        ids = rasterize(shapes, out_shape = (src.height, src.width),
+                        transform = src.transform, fill = 0, dtype = 'uint16')
+    profile.update(count = 1, dtype = 'uint16', nodata = 0, compress = 'deflate')
+    with rasterio.open(out_path, 'w', **profile) as dst:
+        dst.write(ids, 1)
+    return codes
+
+
+### HISTOGRAMS ################################################################
+
+def tile_counts(regions, mask, n_regions, name = 'region raster'):
+    """(n_regions + 1, 9) pixel counts of a tile, by region ID and mask value.
+
+    ``name`` identifies the region raster in the error raised for IDs
+    outside 0..n_regions.
+    """
+    if regions.size and (regions.min() < 0 or regions.max() > n_regions):
+        raise ValueError(f'{name}: region IDs {regions.min()}..{regions.max()} '
+                         f'outside 0..{n_regions}, the codes of the histogram')
+    index = regions.astype(np.int64) * N_MASK_VALUES + mask
+    counts = np.bincount(index.ravel(), minlength = (n_regions + 1) * N_MASK_VALUES)
+    return counts.reshape(n_regions + 1, N_MASK_VALUES)
+
+
+class RegionHistogram:
+    """Per-region class pixel counts accumulated tile by tile.
+
+    ``counts[i, v]`` is the number of pixels of region ``i`` (0: none) with
+    mask value ``v``. Column 0 only sees the out-of-area pixels of tiles that
+    were classified, since all-zero tiles are skipped; it is never used for
+    the class shares.
+    """
+
+    def __init__(self, codes):
+        self.codes = list(codes)
+        self.counts = np.zeros((len(self.codes) + 1, N_MASK_VALUES), dtype = np.int64)
+
+    @property
+    def n_regions(self):
+        return len(self.codes)
+
+    def add(self, counts):
+        self.counts += counts
+
+    def add_tile(self, regions, mask):
+        self.add(tile_counts(regions, mask, self.n_regions))
+
+    def class_counts(self):
+        """{code: counts of classes A..H}, for regions with classified pixels."""
+        result = {}
+        for i, code in enumerate(self.codes, start = 1):
+            counts = self.counts[i, 1:]
+            if counts.sum():
+                result[code] = counts
+        return result
+
+    def distributions(self):
+        """{code: class shares A..H} of every region with classified pixels."""
+        return {code : counts / counts.sum()
+                for code, counts in self.class_counts().items()}
+
+    def save(self, path):
+        np.savez(path, codes = np.asarray(self.codes), counts = self.counts)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            histogram = cls(f['codes'].tolist())
+            histogram.counts = f['counts']
+        return histogram
+
+
+### LUCAS COMPARISON ##########################################################
+
+def read_lucas_statistics(path, code_column = 'NUTS_ID'):
+    """Lucas land-cover statistics from a CSV table, normalised per region.
+
+    Class columns may be named by letter (A..H) or by class name; values can
+    be areas or percentages.
+    """
+    distributions = {}
+    with open(path, newline = '') as f:
+        for row in csv.DictReader(f):
+            values = []
+            for code, name in zip(CLASS_CODES, CLASS_NAMES):
+                value = row.get(code, row.get(name))
+                if value is None:
+                    raise ValueError(f'{path}: no column for class {code} ({name})')
+                values.append(float(value or 0))
+            values = np.asarray(values)
+            distributions[row[code_column]] = values / values.sum()
+    return distributions
+
+
+def kl_divergence(p, q, eps = 1e-10):
+    """D(p || q) in nats; zero shares in ``q`` are clipped to ``eps``."""
+    p = np.asarray(p, dtype = np.float64)
+    q = np.clip(np.asarray(q, dtype = np.float64), eps, None)
+    nonzero = p > 0
+    return float(np.sum(p[nonzero] * np.log(p[nonzero] / q[nonzero])))
+
+
+def compare(histogram, lucas):
+    """Per-region comparison rows for every region present in both inputs."""
+    rows = []
+    for code, counts in histogram.class_counts().items():
+        if code not in lucas:
+            continue
+        predicted = counts / counts.sum()
+        row = {'region' : code, 'pixels' : int(counts.sum()),
+               'kl_divergence' : kl_divergence(lucas[code], predicted)}
+        for c, share, reference in zip(CLASS_CODES, predicted, lucas[code]):
+            row[f'{c}_predicted'] = float(share)
+            row[f'{c}_lucas'] = float(reference)
+        rows.append(row)
+    return rows
+
+
+def write_report(rows, path):
+    if not rows:
+        raise ValueError('No region found in both the maps and the Lucas table')
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok = True)
+    with open(path, 'w', newline = '') as f:
+        writer = csv.DictWriter(f, fieldnames = list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
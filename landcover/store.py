@@ -0,0 +1,281 @@
+"""Memory-mapped columnar store for the flattened Lucas reflectance database.
+
+The training database is one row per Lucas point: the land-cover class and
+the 108 reflectances of its 3x3x12 patch. Instead of a CSV/pickle that is
+parsed into float64 frames on every run, a store is a directory of ``.npy``
+files:
+
+* ``reflectance-00000.npy``: (rows, 3, 3, 12) uint16 reflectances;
+  :meth:`LucasStore.append` (e.g. one call per survey year) writes the new
+  rows at the end of the file and grows its header in place;
+* ``lc1.npy`` (class index 0..7 for A..H), ``country.npy``,
+  ``survey_date.npy`` (datetime64[D]), ``shift.npy`` (augmentation offset in
+  months) and ``point_id.npy`` side columns;
+* ``meta.json`` with the row count of every chunk.
+
+Opening a store only reads ``meta.json`` and maps the arrays, so it takes
+milliseconds, and worker processes that open the same store share one
+page-cache copy of it. The 108-column rows and the 1x1 centre-pixel rows
+are views over the same reflectance array, never a second copy. Stores
+written by earlier versions may hold one file per append; their views
+refuse to build an in-memory copy until :meth:`LucasStore.compact` merges
+them.
+"""
+
+import io
+import json
+import os
+
+import numpy as np
+
+from landcover import CLASS_CODES, N_BANDS
+
+
+PATCH_SHAPE = (3, 3, N_BANDS)
+
+SIDE_COLUMNS = {'lc1' : np.uint8,
+                'country' : 'U2',
+                'survey_date' : 'datetime64[D]',
+                'shift' : np.int8,
+                'point_id' : 'U16'}
+
+
+def _chunk_name(i):
+    return f'reflectance-{i:05d}.npy'
+
+
+def _append_rows(path, rows):
+    """Write ``rows`` at the end of the .npy file ``path``, without copying it.
+
+    The data goes first and the header (whose new shape fits in the padding
+    NumPy leaves for growth) last, so an interrupted append leaves the file
+    readable with its old shape. Returns False, writing nothing, when the
+    new header would not fit.
+    """
+    with open(path, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+        header_size = f.tell()
+        if fortran or dtype != rows.dtype or shape[1:] != rows.shape[1:]:
+            raise ValueError(f'{path}: cannot append {rows.dtype} {rows.shape[1:]} rows '
+                             f'to {dtype} {shape[1:]} data')
+        header = io.BytesIO()
+        np.lib.format.write_array_header_1_0(
+            header, {'descr' : np.lib.format.dtype_to_descr(dtype),
+                     'fortran_order' : False,
+                     'shape' : (shape[0] + rows.shape[0],) + shape[1:]})
+        if version != (1, 0) or len(header.getvalue()) != header_size:
+            return False
+        f.seek(header_size + int(np.prod(shape)) * dtype.itemsize)
+        f.write(np.ascontiguousarray(rows).tobytes())
+        f.flush()
+        f.seek(0)
+        f.write(header.getvalue())
+    return True
+
+
+def _rewrite_rows(path, rows):
+    """Slow path of :func:`_append_rows`: copy the file with ``rows`` added."""
+    old = np.load(path, mmap_mode = 'r')
+    tmp = path + '.tmp'
+    merged = np.lib.format.open_memmap(tmp, mode = 'w+', dtype = old.dtype,
+                                       shape = (old.shape[0] + rows.shape[0],) + old.shape[1:])
+    merged[:old.shape[0]] = old
+    merged[old.shape[0]:] = rows
+    merged.flush()
+    del merged, old
+    os.replace(tmp, path)
+
+
+def _check_lc1(lc1):
+    """Class indices 0..7 from class letters A..H or indices; anything else raises."""
+    lc1 = np.asarray(lc1)
+    if lc1.dtype.kind in 'USO':
+        letters = lc1.astype(str)
+        invalid = ~np.isin(letters, list(CLASS_CODES))
+        if invalid.any():
+            raise ValueError(f'lc1: unknown class labels {sorted(set(letters[invalid].tolist()))[:10]}, '
+                             f'expected one of {CLASS_CODES}')
+        return np.searchsorted(np.array(list(CLASS_CODES)), letters)
+    if lc1.size and (lc1.min() < 0 or lc1.max() >= len(CLASS_CODES)):
+        raise ValueError(f'lc1: class indices must be in 0..{len(CLASS_CODES) - 1}')
+    return lc1
+
+
+class LucasStore:
+
+    def __init__(self, path, chunks, columns):
+        self.path = path
+        self._chunks = chunks
+        self.columns = columns
+
+    def __len__(self):
+        return sum(c.shape[0] for c in self._chunks)
+
+    @property
+    def n_chunks(self):
+        return len(self._chunks)
+
+    ### OPEN / WRITE ##########################################################
+
+    @classmethod
+    def open(cls, path, mode = 'r'):
+        """Map an existing store (``mode='r+'`` to modify it in place)."""
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        chunks = [np.load(os.path.join(path, c['file']), mmap_mode = mode)
+                  for c in meta['chunks']]
+        columns = {name : np.load(os.path.join(path, name + '.npy'), mmap_mode = mode)
+                   for name in SIDE_COLUMNS}
+        return cls(path, chunks, columns)
+
+    @classmethod
+    def create(cls, path, patches, lc1, **columns):
+        """Create a store at ``path`` from a first batch of rows."""
+        os.makedirs(path, exist_ok = True)
+        if os.path.exists(os.path.join(path, 'meta.json')):
+            raise FileExistsError(f'A store already exists in {path}')
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'version' : 1, 'chunks' : []}, f)
+        for name, dtype in SIDE_COLUMNS.items():
+            np.save(os.path.join(path, name + '.npy'), np.empty(0, dtype = dtype))
+        store = cls.open(path)
+        store.append(patches, lc1, **columns)
+        return store
+
+    def append(self, patches, lc1, country = None, survey_date = None,
+               shift = None, point_id = None):
+        """Add rows at the end of the store.
+
+        ``patches`` are (n, 3, 3, 12) images or (n, 108) flattened rows;
+        ``lc1`` are class letters A..H or indices 0..7. Missing side columns
+        are filled with empty values. Invalid labels, and strings too long
+        for their column, raise ``ValueError``.
+        """
+        patches = np.asarray(patches)
+        n = patches.shape[0]
+        patches = patches.reshape((n,) + PATCH_SHAPE)
+        if patches.dtype != np.uint16:
+            if patches.min(initial = 0) < 0 or patches.max(initial = 0) > np.iinfo(np.uint16).max:
+                raise ValueError('reflectances do not fit in uint16')
+            patches = patches.astype(np.uint16)
+
+        values = {'lc1' : _check_lc1(lc1), 'country' : country,
+                  'survey_date' : survey_date, 'shift' : shift, 'point_id' : point_id}
+        converted = {}
+        for column, dtype in SIDE_COLUMNS.items():
+            value = values[column]
+            if value is None:
+                converted[column] = np.zeros(n, dtype = dtype)
+                continue
+            value = np.asarray(value)
+            if value.shape != (n,):
+                raise ValueError(f'{column}: expected {n} values, got {value.shape}')
+            if np.dtype(dtype).kind == 'U' and value.size:
+                width = np.dtype(dtype).itemsize // 4
+                longest = int(np.char.str_len(value.astype(str)).max())
+                if longest > width:
+                    raise ValueError(f'{column}: values up to {width} characters, '
+                                     f'got one of {longest}')
+            converted[column] = value.astype(dtype)
+
+        if len(self._chunks) > 1:
+            raise ValueError(f'{self.path} holds {len(self._chunks)} reflectance files: '
+                             'compact() it before appending')
+        if self._chunks:
+            target = os.path.join(self.path, _chunk_name(0))
+            if not _append_rows(target, patches):
+                _rewrite_rows(target, patches)
+        else:
+            np.save(os.path.join(self.path, _chunk_name(0)), patches)
+        for column, value in converted.items():
+            merged = np.concatenate([np.asarray(self.columns[column]), value])
+            np.save(os.path.join(self.path, column + '.npy'), merged)
+
+        rows = len(self) + n
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump({'version' : 1, 'chunks' : [{'file' : _chunk_name(0), 'rows' : rows}]}, f)
+
+        reopened = LucasStore.open(self.path)
+        self._chunks, self.columns = reopened._chunks, reopened.columns
+        return self
+
+    def compact(self):
+        """Merge the reflectance files of an older store into one."""
+        if len(self._chunks) <= 1:
+            return self
+        target = os.path.join(self.path, _chunk_name(0) + '.tmp')
+        merged = np.lib.format.open_memmap(target, mode = 'w+', dtype = np.uint16,
+                                           shape = (len(self),) + PATCH_SHAPE)
+        start = 0
+        for chunk in self._chunks:
+            merged[start:start + chunk.shape[0]] = chunk
+            start += chunk.shape[0]
+        merged.flush()
+        del merged
+        files = [_chunk_name(i) for i in range(len(self._chunks))]
+        self._chunks = []
+        os.replace(target, os.path.join(self.path, files[0]))
+        for name in files[1:]:
+            os.remove(os.path.join(self.path, name))
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump({'version' : 1, 'chunks' : [{'file' : files[0], 'rows' : start}]}, f)
+        reopened = LucasStore.open(self.path)
+        self._chunks, self.columns = reopened._chunks, reopened.columns
+        return self
+
+    ### VIEWS #################################################################
+
+    @property
+    def patches(self):
+        """(n, 3, 3, 12) uint16 reflectances, a memory map of the file."""
+        if len(self._chunks) != 1:
+            # concatenating would give every reader a private in-memory copy
+            raise ValueError(f'{self.path} holds {len(self._chunks)} reflectance files: '
+                             'open it with mode="r+" and compact() it first')
+        return self._chunks[0]
+
+    def chunks(self):
+        """Iterate over the (rows, 3, 3, 12) reflectance chunks without copying."""
+        return iter(self._chunks)
+
+    @property
+    def rows_3x3(self):
+        """(n, 108) training rows, pixel-major with bands varying fastest."""
+        patches = self.patches
+        return patches.reshape(patches.shape[0], -1)
+
+    @property
+    def rows_1x1(self):
+        """(n, 12) centre-pixel rows: a strided view of the 3x3 data."""
+        return self.patches[:, 1, 1, :]
+
+    @property
+    def lc1(self):
+        return self.columns['lc1']
+
+    @property
+    def labels(self):
+        """Class letters A..H."""
+        return np.array(list(CLASS_CODES))[self.columns['lc1']]
+
+
+def from_extraction(path, extraction_dir, points):
+    """Build a store from the shards of :func:`landcover.extraction.extract`.
+
+    ``points`` are the :class:`~landcover.extraction.LucasPoint` records the
+    extraction was run on; they provide the side columns.
+    """
+    from landcover.extraction import load_patches
+    ids, patches = load_patches(extraction_dir)
+    by_id = {p.point_id : p for p in points}
+    rows = [by_id[i] for i in ids]
+    return LucasStore.create(path, patches,
+                             [p.lc1 for p in rows],
+                             country = [p.country for p in rows],
+                             survey_date = [np.datetime64(p.survey_date, 'D') for p in rows],
+                             shift = [p.shift for p in rows],
+                             point_id = ids)
@@ -0,0 +1,369 @@
+"""Precomputed XYZ tile pyramids for the map pages.
+
+The Database creation and Map classification pages used to rebuild their
+``foliumap.Map`` on every Streamlit rerun from live Earth Engine objects (the
+Sentinel-2 median mosaic, the per-feature styled Lucas collection and the
+``users/federicopavesiwork/*`` images). :func:`build_pyramid` renders the same
+layers once into ``{layer}/{z}/{x}/{y}.png`` Web Mercator tiles on disk:
+
+* true colour images (3-band uint8, all-zero pixels transparent);
+* classification masks (values 0..8, coloured with :data:`MASK_PALETTE`,
+  0 transparent);
+* Lucas points (coloured by LC1 with :data:`LUCAS_PALETTE`).
+
+The map HTML is rendered in the viewer's browser, so the pages only use the
+tiles when ``LANDCOVER_TILE_URL`` gives a base URL that the browser can reach
+(a static file host, a CDN, a reverse proxy to ``tiles/``). With
+``LANDCOVER_TILE_URL=local`` the pages start :func:`serve_tiles`, a small
+HTTP server on 127.0.0.1, which only works when the browser runs on the same
+machine as Streamlit.
+
+Rasters are georeferenced in EPSG:4326, the default of Earth Engine exports,
+either as GeoTIFFs (needs ``rasterio``) or as ``.npy`` arrays with a
+``.json`` sidecar holding ``transform`` or ``bounds`` (as written by
+:class:`landcover.classification.MaskWriter`).
+
+The pages look for the layers ``s2_median`` and ``lucas_points`` (Database
+creation) and ``lazio_tci``, ``mlp_1x1``, ``mlp_3x3``, ``rf_1x1``,
+``rf_3x3`` (Map classification) in ``tiles/`` and fall back to live Earth
+Engine when they are missing or no tile URL is configured. Build them with e.g.::
+
+    python -m landcover.tiles --out tiles --zoom 6-12 \\
+        --rgb lazio_tci="Lazio TCI" exports/Lazio_2018_TCI*.tif \\
+        --mask rf_1x1="RF 1x1" masks/rf11/*_mask.npy \\
+        --points lucas_points="Lucas Points" lucas_2018.csv
+"""
+
+import argparse
+import functools
+import http.server
+import json
+import math
+import os
+import threading
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from landcover import CLASS_CODES, timing
+
+
+TILE_SIZE = 256
+
+# viz_params palette of the Map classification page, indexed by mask value
+MASK_PALETTE = ['#000000', '#ff0101', '#ffff01', '#336601', '#ff8001',
+                '#01ff01', '#808080', '#0101ff', '#99ffff']
+
+# lucas_par palette of the Database creation page, by LC1 letter
+LUCAS_PALETTE = dict(zip(CLASS_CODES, MASK_PALETTE[1:]))
+
+
+def _rgb(color):
+    return tuple(int(color[i:i + 2], 16) for i in (1, 3, 5))
+
+
+### RASTERS ###################################################################
+
+class GeoRaster:
+    """Lazy EPSG:4326 raster: (rows, cols) mask or (rows, cols, 3) image."""
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.array = None
+        self._dataset = None
+        if self.path.endswith('.npy'):
+            self.array = np.load(self.path, mmap_mode = 'r')
+            with open(os.path.splitext(self.path)[0] + '.json') as f:
+                georef = json.load(f)
+            crs = georef.get('crs', 'EPSG:4326')
+            self.shape = self.array.shape
+            rows, cols = self.shape[:2]
+            if 'transform' in georef:
+                a, b, c, d, e, f = georef['transform']
+            else:
+                west, south, east, north = georef['bounds']
+                a, b, c, d, e, f = (east - west) / cols, 0, west, 0, -(north - south) / rows, north
+        elif self.path.endswith(('.tif', '.tiff')):
+            import rasterio
+            self._dataset = rasterio.open(self.path)
+            crs = str(self._dataset.crs)
+            a, b, c, d, e, f = list(self._dataset.transform)[:6]
+            count = self._dataset.count
+            self.shape = (self._dataset.height, self._dataset.width) + ((count,) if count > 1 else ())
+        else:
+            raise ValueError(f'Unsupported raster format: {self.path}')
+        if '4326' not in str(crs) or b or d:
+            raise ValueError(f'{self.path}: expected a north-up EPSG:4326 raster, got {crs}')
+        self.a, self.c, self.e, self.f = a, c, e, f
+
+    @property
+    def bounds(self):
+        rows, cols = self.shape[:2]
+        return (self.c, self.f + self.e * rows, self.c + self.a * cols, self.f)
+
+    def _read(self, r, c):
+        """Pixels at the (increasing) row and column indices ``r`` x ``c``."""
+        if self.array is not None:
+            return self.array[np.ix_(r, c)]
+        from rasterio.windows import Window
+        r0, r1, c0, c1 = r[0], r[-1] + 1, c[0], c[-1] + 1
+        # at low zooms read a decimated window instead of the full resolution
+        h, w = min(r1 - r0, 4 * TILE_SIZE), min(c1 - c0, 4 * TILE_SIZE)
+        block = self._dataset.read(window = Window(c0, r0, c1 - c0, r1 - r0),
+                                   out_shape = (self._dataset.count, h, w))
+        block = block[:, (r - r0) * h // (r1 - r0)][:, :, (c - c0) * w // (c1 - c0)]
+        return block[0] if block.shape[0] == 1 else block.transpose(1, 2, 0)
+
+    def sample(self, lon, lat):
+        """Nearest pixels for a grid of ``lat`` rows and ``lon`` columns.
+
+        Returns (values, valid) where ``valid`` marks grid cells inside the
+        raster; only the sampled rows and columns are read.
+        """
+        rows, cols = self.shape[:2]
+        r = np.floor((lat - self.f) / self.e).astype(np.int64)
+        c = np.floor((lon - self.c) / self.a).astype(np.int64)
+        r_ok = (r >= 0) & (r < rows)
+        c_ok = (c >= 0) & (c < cols)
+        dtype = self.array.dtype if self.array is not None else self._dataset.dtypes[0]
+        values = np.zeros((lat.size, lon.size) + self.shape[2:], dtype = dtype)
+        if r_ok.any() and c_ok.any():
+            values[np.ix_(r_ok, c_ok)] = self._read(r[r_ok], c[c_ok])
+        return values, np.outer(r_ok, c_ok)
+
+
+### WEB MERCATOR ##############################################################
+
+def tile_range(bounds, zoom):
+    """Inclusive x and y tile ranges covering (west, south, east, north)."""
+    west, south, east, north = bounds
+    n = 2 ** zoom
+
+    def x(lon):
+        return min(n - 1, max(0, int((lon + 180.0) / 360.0 * n)))
+
+    def y(lat):
+        lat = max(min(lat, 85.0511), -85.0511)
+        return min(n - 1, max(0, int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)))
+
+    return (x(west), x(east)), (y(north), y(south))
+
+
+def tile_grid(zoom, x, y):
+    """Longitudes of the pixel columns and latitudes of the pixel rows of a tile."""
+    scale = TILE_SIZE * 2 ** zoom
+    px = (x * TILE_SIZE + np.arange(TILE_SIZE) + 0.5) / scale
+    py = (y * TILE_SIZE + np.arange(TILE_SIZE) + 0.5) / scale
+    lon = px * 360.0 - 180.0
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1.0 - 2.0 * py))))
+    return lon, lat
+
+
+def _global_pixels(lon, lat, zoom):
+    scale = TILE_SIZE * 2 ** zoom
+    lat = np.clip(lat, -85.0511, 85.0511)
+    px = (lon + 180.0) / 360.0 * scale
+    py = (1.0 - np.arcsinh(np.tan(np.radians(lat))) / np.pi) / 2.0 * scale
+    return px, py
+
+
+### LAYERS ####################################################################
+
+class RasterLayer:
+    """Mask (``kind='mask'``) or true colour (``kind='rgb'``) raster slices."""
+
+    def __init__(self, paths, kind):
+        if kind not in ('mask', 'rgb'):
+            raise ValueError(f'Unknown raster layer kind: {kind}')
+        self.kind = kind
+        self.rasters = [GeoRaster(p) for p in paths]
+        bounds = np.array([r.bounds for r in self.rasters])
+        self.bounds = (bounds[:, 0].min(), bounds[:, 1].min(),
+                       bounds[:, 2].max(), bounds[:, 3].max())
+        lut = np.zeros((256, 4), dtype = np.uint8)
+        for value, color in enumerate(MASK_PALETTE[1:], start = 1):
+            lut[value] = _rgb(color) + (255,)
+        self.lut = lut
+
+    def render(self, zoom, x, y):
+        lon, lat = tile_grid(zoom, x, y)
+        west, south, east, north = self.bounds
+        if lon[-1] < west or lon[0] > east or lat[0] < south or lat[-1] > north:
+            return None
+        rgba = np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype = np.uint8)
+        for raster in self.rasters:
+            values, inside = raster.sample(lon, lat)
+            if self.kind == 'mask':
+                colored = self.lut[values]
+            else:
+                colored = np.concatenate([values[..., :3].astype(np.uint8),
+                                          np.where(values.any(axis = 2), 255, 0)
+                                          .astype(np.uint8)[..., None]], axis = 2)
+            # later slices only fill what earlier ones left transparent
+            fill = inside & (colored[..., 3] > 0) & (rgba[..., 3] == 0)
+            rgba[fill] = colored[fill]
+        if not rgba[..., 3].any():
+            return None
+        return Image.fromarray(rgba, 'RGBA')
+
+
+class PointLayer:
+    """Lucas points drawn as dots coloured by their one-digit class."""
+
+    def __init__(self, lon, lat, lc1, radius = 3):
+        self.lon = np.asarray(lon, dtype = np.float64)
+        self.lat = np.asarray(lat, dtype = np.float64)
+        self.lc1 = np.asarray(lc1)
+        self.radius = radius
+        self.bounds = (self.lon.min(), self.lat.min(), self.lon.max(), self.lat.max())
+        self._zoom = None
+
+    @classmethod
+    def from_csv(cls, path, **kwargs):
+        from landcover.extraction import read_points
+        points = read_points(path)
+        return cls([p.lon for p in points], [p.lat for p in points],
+                   [p.lc1 for p in points], **kwargs)
+
+    def render(self, zoom, x, y):
+        if self._zoom != zoom:
+            # global pixel positions, bucketed by tile once per zoom level
+            self._zoom = zoom
+            px, py = _global_pixels(self.lon, self.lat, zoom)
+            self._px, self._py = px, py
+            self._tiles = {}
+            # a dot near a tile edge is drawn on every tile it overlaps
+            r = self.radius
+            x0, x1 = ((px - r) // TILE_SIZE).astype(np.int64), ((px + r) // TILE_SIZE).astype(np.int64)
+            y0, y1 = ((py - r) // TILE_SIZE).astype(np.int64), ((py + r) // TILE_SIZE).astype(np.int64)
+            for i in range(px.size):
+                for tx in {x0[i], x1[i]}:
+                    for ty in {y0[i], y1[i]}:
+                        self._tiles.setdefault((tx, ty), []).append(i)
+        index = self._tiles.get((x, y))
+        if not index:
+            return None
+        image = Image.new('RGBA', (TILE_SIZE, TILE_SIZE), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(image)
+        r = self.radius
+        for i in index:
+            cx, cy = self._px[i] - x * TILE_SIZE, self._py[i] - y * TILE_SIZE
+            draw.ellipse((cx - r, cy - r, cx + r, cy + r),
+                         fill = LUCAS_PALETTE.get(str(self.lc1[i]), '#000000'))
+        return image
+
+
+### PYRAMID ###################################################################
+
+def build_pyramid(layers, out_dir, zooms = range(6, 13)):
+    """Render ``layers`` {layer_id: (name, layer)} into ``out_dir``.
+
+    Tiles without any visible pixel are not written; the map shows them as
+    transparent. ``layers.json`` lists the rendered layers for the pages;
+    entries from earlier runs into ``out_dir`` are kept, so layers can be
+    built in separate runs. Returns the entries of this run.
+    """
+    with timing.stage('build_pyramid') as record:
+        index = {}
+        for layer_id, (name, layer) in layers.items():
+            written = 0
+            for zoom in zooms:
+                (x0, x1), (y0, y1) = tile_range(layer.bounds, zoom)
+                for x in range(x0, x1 + 1):
+                    for y in range(y0, y1 + 1):
+                        image = layer.render(zoom, x, y)
+                        if image is None:
+                            continue
+                        path = os.path.join(out_dir, layer_id, str(zoom), str(x), f'{y}.png')
+                        os.makedirs(os.path.dirname(path), exist_ok = True)
+                        image.save(path, optimize = True)
+                        written += 1
+            index[layer_id] = {'name' : name, 'bounds' : list(map(float, layer.bounds)),
+                               'min_zoom' : min(zooms), 'max_zoom' : max(zooms),
+                               'tiles' : written}
+        record['items'] = sum(info['tiles'] for info in index.values())
+    os.makedirs(out_dir, exist_ok = True)
+    # layers built by earlier runs stay listed
+    merged = read_layers(out_dir)
+    merged.update(index)
+    tmp = os.path.join(out_dir, 'layers.json.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(merged, f, indent = 1)
+    os.replace(tmp, os.path.join(out_dir, 'layers.json'))
+    return index
+
+
+def read_layers(tiles_dir):
+    """Layers available in a built pyramid, or {} if there is none."""
+    try:
+        with open(os.path.join(tiles_dir, 'layers.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+### SERVING ###################################################################
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def end_headers(self):
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Cache-Control', 'public, max-age=86400')
+        super().end_headers()
+
+
+def serve_tiles(tiles_dir, host = '127.0.0.1', port = 0):
+    """Serve ``tiles_dir`` over HTTP from a daemon thread; return its base URL.
+
+    The URL names ``host`` as seen from this machine: it is only reachable
+    by browsers running here, or behind a proxy that forwards to it.
+    """
+    handler = functools.partial(_QuietHandler, directory = os.path.abspath(tiles_dir))
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return f'http://{host}:{server.server_address[1]}'
+
+
+def tile_url(base_url, layer_id):
+    return f'{base_url}/{layer_id}/{{z}}/{{x}}/{{y}}.png'
+
+
+### COMMAND LINE ##############################################################
+
+def _zooms(text):
+    low, _, high = text.partition('-')
+    return range(int(low), int(high or low) + 1)
+
+
+def _layer_args(values):
+    """``id="Name" path [path ...]`` -> (id, name, paths)."""
+    layer_id, _, name = values[0].partition('=')
+    return layer_id, name or layer_id, values[1:]
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Build the map tile pyramid.')
+    parser.add_argument('--out', default = 'tiles')
+    parser.add_argument('--zoom', type = _zooms, default = range(6, 13))
+    parser.add_argument('--rgb', nargs = '+', action = 'append', default = [])
+    parser.add_argument('--mask', nargs = '+', action = 'append', default = [])
+    parser.add_argument('--points', nargs = 2, action = 'append', default = [])
+    args = parser.parse_args(argv)
+
+    layers = {}
+    for kind, specs in (('rgb', args.rgb), ('mask', args.mask)):
+        for values in specs:
+            layer_id, name, paths = _layer_args(values)
+            layers[layer_id] = (name, RasterLayer(paths, kind))
+    for values in args.points:
+        layer_id, name, paths = _layer_args(values)
+        layers[layer_id] = (name, PointLayer.from_csv(paths[0]))
+    for layer_id, info in build_pyramid(layers, args.out, args.zoom).items():
+        print(f"{layer_id}: {info['tiles']} tiles")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""Per-stage timers for the pipeline and the benchmark suite.
+
+Pipeline entry points (extraction, classification, experiments, tile
+building) run inside :func:`stage`, which records wall time, the number of
+items processed (points, pixels, fits, tiles) and the peak resident memory
+of the stage.
+
+On Linux the peak is the stage's own: the kernel's high-water mark is reset
+when the stage starts (``/proc/self/clear_refs``) and read when it ends
+(``VmHWM``), so stages do not inherit each other's peaks as long as they are
+not nested. Elsewhere only the lifetime peak of the process is available;
+records then carry ``peak_rss_scope = 'process'``. The peak of worker
+processes (``peak_rss_children_mb``) is always the largest of any finished
+child of the process.
+
+Records are kept in :data:`records` and, when the ``LANDCOVER_TIMINGS``
+environment variable names a file, appended to it as JSON lines. The
+Performance page reads that file.
+"""
+
+import json
+import os
+import re
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+
+records = []
+
+
+def peak_rss_mb(children = False):
+    """Peak resident set size of this process (or of its finished children)."""
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    peak = resource.getrusage(who).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def reset_peak_rss():
+    """Reset the peak RSS of this process; False where the OS cannot."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def current_peak_rss_mb():
+    """Peak RSS since the last :func:`reset_peak_rss` (Linux), else None."""
+    try:
+        with open('/proc/self/status') as f:
+            match = re.search(r'^VmHWM:\s+(\d+) kB', f.read(), re.MULTILINE)
+    except OSError:
+        return None
+    return int(match.group(1)) / 1024 if match else None
+
+
+@contextmanager
+def stage(name, items = None, **info):
+    """Time the enclosed block as pipeline stage ``name``.
+
+    The yielded record can be updated inside the block, e.g. with the
+    number of ``items`` once it is known.
+    """
+    record = {'stage' : name, 'items' : items, **info}
+    scoped = reset_peak_rss()
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['seconds'] = time.perf_counter() - start
+        if record['items']:
+            record['items_per_second'] = record['items'] / record['seconds']
+        peak = current_peak_rss_mb() if scoped else None
+        record['peak_rss_mb'] = peak if peak is not None else peak_rss_mb()
+        record['peak_rss_scope'] = 'stage' if peak is not None else 'process'
+        record['peak_rss_children_mb'] = peak_rss_mb(children = True)
+        record['time'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+        records.append(record)
+        path = os.environ.get('LANDCOVER_TIMINGS')
+        if path:
+            with open(path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+
+def read_records(path):
+    """Records appended to a ``LANDCOVER_TIMINGS`` file, oldest first."""
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
@@ -1,7 +1,9 @@
+import os
 import streamlit as st
+import streamlit.components.v1 as components
 from PIL import Image
 from geemap import foliumap
-import ee
+from landcover import tiles
 
 
 
@@ -41,68 +43,104 @@ st.markdown('The merging process between Lucas points and sentinel-2 images is p
 
 # CODE --------------------------------------------------
 
-start_date = '2018-01-01'
-end_date = '2018-12-31'
-cloud_filter = 20
-bands = ['TCI_R', 'TCI_G', 'TCI_B']
+TILES_DIR = 'tiles'
 
-s2a = (ee.ImageCollection('COPERNICUS/S2_SR').
-       filterDate(start_date, end_date)
-       .filter(ee.Filter.lte('CLOUDY_PIXEL_PERCENTAGE', cloud_filter)))
+map_layers = [('s2_median', 'Sentinel-2 2018 median'),
+              ('lucas_points', 'Lucas Points')]
 
+color_dict = {'Artificial Land' : '#ff0101',
+             'Cropland' : '#ffff01',
+             'Woodland' : '#336601',
+             'Shrubland' : '#ff8001',
+             'Greenland' : '#01ff01',
+             'Bareland' : '#808080',
+             'Water' : '#0101ff',
+             'Wetlands' : '#99ffff'}
 
-mosaic = s2a.select(bands).reduce(ee.Reducer.median())
 
-mosaic = mosaic.uint8()
+@st.experimental_singleton
+def tile_server():
+    return tiles.serve_tiles(TILES_DIR)
 
 
-lucas = ee.FeatureCollection('projects/sentinel2download332224/assets/lucas_full')
+def tile_base_url():
+    # tiles must be reachable from the viewer's browser: a public URL, or
+    # 'local' for the built-in server when browsing on this machine
+    base_url = os.environ.get('LANDCOVER_TILE_URL')
+    if base_url == 'local':
+        return tile_server()
+    return base_url
 
-Map = foliumap.Map(center = [41.902782, 12.496366],
-                   zoom = 8)
 
-vizParams = {
-  'bands': ['TCI_R_median', 'TCI_G_median', 'TCI_B_median'],
-  'min': 0,
-  'max': 255
-}
+def earth_engine_layers(Map):
+    import ee
 
-lucas_par = ee.Dictionary({'A' : '#ff0101',
-             'B' : '#ffff01',
-             'C' : '#336601',
-             'D' : '#ff8001',
-             'E' : '#01ff01',
-             'F' : '#808080',
-             'G' : '#0101ff',
-             'H' : '#99ffff'})
+    start_date = '2018-01-01'
+    end_date = '2018-12-31'
+    cloud_filter = 20
+    bands = ['TCI_R', 'TCI_G', 'TCI_B']
 
+    s2a = (ee.ImageCollection('COPERNICUS/S2_SR').
+           filterDate(start_date, end_date)
+           .filter(ee.Filter.lte('CLOUDY_PIXEL_PERCENTAGE', cloud_filter)))
+
+
+    mosaic = s2a.select(bands).reduce(ee.Reducer.median())
+
+    mosaic = mosaic.uint8()
 
-color_dict = {'Artificial Land' : '#ff0101',
-             'Cropland' : '#ffff01',
-             'Woodland' : '#336601',
-             'Shrubland' : '#ff8001',
-             'Greenland' : '#01ff01',
-             'Bareland' : '#808080',
-             'Water' : '#0101ff',
-             'Wetlands' : '#99ffff'}
 
+    lucas = ee.FeatureCollection('projects/sentinel2download332224/assets/lucas_full')
 
-def pointstyle(f):
-    kl = f.get('LC1')
-    return f.set({'style' : {'fillColor' : lucas_par.get(kl)}})
+    vizParams = {
+      'bands': ['TCI_R_median', 'TCI_G_median', 'TCI_B_median'],
+      'min': 0,
+      'max': 255
+    }
 
-styled = lucas.map(pointstyle).style(styleProperty = 'style')
+    lucas_par = ee.Dictionary(tiles.LUCAS_PALETTE)
 
+    def pointstyle(f):
+        kl = f.get('LC1')
+        return f.set({'style' : {'fillColor' : lucas_par.get(kl)}})
 
-Map.addLayer(mosaic, vizParams, 'Sentinel-2 2018 median')
-Map.addLayer(styled, name =  'Lucas Points')
-Map.add_legend(legend_title="NLCD Land Cover Classification", legend_dict=color_dict)
+    styled = lucas.map(pointstyle).style(styleProperty = 'style')
 
-Map.to_streamlit()
 
+    Map.addLayer(mosaic, vizParams, 'Sentinel-2 2018 median')
+    Map.addLayer(styled, name =  'Lucas Points')
 
 
+@st.experimental_memo
+def local_map_html(base_url, layers_mtime):
+    # prebuilt tile pyramid (python -m landcover.tiles), no Earth Engine;
+    # layers_mtime only keys the cache so a rebuilt pyramid is picked up
+    Map = foliumap.Map(center = [41.902782, 12.496366],
+                       zoom = 8, ee_initialize = False)
+    for layer_id, name in map_layers:
+        Map.add_tile_layer(tiles.tile_url(base_url, layer_id), name = name,
+                           attribution = 'Copernicus Sentinel-2, Eurostat Lucas')
+    Map.add_legend(legend_title="NLCD Land Cover Classification", legend_dict=color_dict)
+    return Map.to_html(height = '600px')
 
 
+def map_html():
+    available = tiles.read_layers(TILES_DIR)
+    pyramid = all(layer_id in available for layer_id, _ in map_layers)
+    base_url = tile_base_url()
+    if pyramid and base_url:
+        layers_mtime = os.path.getmtime(os.path.join(TILES_DIR, 'layers.json'))
+        return local_map_html(base_url, layers_mtime)
+    if pyramid:
+        st.info(f'A tile pyramid is available in `{TILES_DIR}` but `LANDCOVER_TILE_URL` is not set, so the map below is computed by Earth Engine on every rerun. Set it to the public URL serving `{TILES_DIR}`, or to `local` when the browser runs on this machine.')
+    else:
+        st.caption('Map layers are computed live by Earth Engine on every rerun: build them once with `python -m landcover.tiles` and set `LANDCOVER_TILE_URL` to serve them instead.')
+    # Earth Engine tile URLs carry expiring tokens: never cached
+    Map = foliumap.Map(center = [41.902782, 12.496366],
+                       zoom = 8)
+    earth_engine_layers(Map)
+    Map.add_legend(legend_title="NLCD Land Cover Classification", legend_dict=color_dict)
+    return Map.to_html(height = '600px')
 
 
+components.html(map_html(), height = 600)
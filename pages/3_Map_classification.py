@@ -1,7 +1,9 @@
+import os
 import streamlit as st
+import streamlit.components.v1 as components
 from geemap import foliumap
 from PIL import Image
-import ee
+from landcover import tiles
 
 st.markdown('# Map classification')
 
@@ -10,20 +12,17 @@ st.markdown('In previous section, we evaluated performances in a train, validati
 st.markdown('Below, it is possible to appreaciate land cover masks for each classification algorithm (they must be activated in the upper-right hand side of the map) on region Lazio.')
 
 
-Map = foliumap.Map(center = [41.902782, 12.496366],
-                   zoom = 8)
+TILES_DIR = 'tiles'
 
-
-lazio_TCI = ee.Image('users/federicopavesiwork/Lazio_2018_TCI')
-mlp11 = ee.Image('users/federicopavesiwork/MLP_1x1')
-mlp33 = ee.Image('users/federicopavesiwork/MLP_3x3')
-rf11 = ee.Image('users/federicopavesiwork/RF_1x1')
-rf33 = ee.Image('users/federicopavesiwork/RF_3x3')
+map_layers = [('lazio_tci', 'Lazio TCI', True),
+              ('mlp_1x1', 'MLP 1x1', False),
+              ('mlp_3x3', 'MLP 3x3', False),
+              ('rf_1x1', 'RF 1x1', False),
+              ('rf_3x3', 'RF 3x3', False)]
 
 viz_params = {'min' : 0, 
               'max' : 8,
-             'palette' : ['#000000', '#ff0101', '#ffff01', '#336601', '#ff8001',
-                         '#01ff01', '#808080', '#0101ff', '#99ffff']}
+             'palette' : tiles.MASK_PALETTE}
 
 rgb_params = {'min' : 1, 'max' : 255}
 
@@ -36,15 +35,65 @@ color_dict = {'Artificial Land' : '#ff0101',
              'Water' : '#0101ff',
              'Wetlands' : '#99ffff'}
 
-Map.addLayer(lazio_TCI, rgb_params, name = 'Lazio TCI')
-Map.addLayer(mlp11, viz_params, name = 'MLP 1x1', shown = False)
-Map.addLayer(mlp33, viz_params, name = 'MLP 3x3', shown = False)
-Map.addLayer(rf11, viz_params, name = 'RF 1x1', shown = False)
-Map.addLayer(rf33, viz_params, name = 'RF 3x3', shown = False)
-Map.add_legend(legend_title="NLCD Land Cover Classification", legend_dict=color_dict)
-
 
-Map.to_streamlit()
+@st.experimental_singleton
+def tile_server():
+    return tiles.serve_tiles(TILES_DIR)
+
+
+def tile_base_url():
+    # tiles must be reachable from the viewer's browser: a public URL, or
+    # 'local' for the built-in server when browsing on this machine
+    base_url = os.environ.get('LANDCOVER_TILE_URL')
+    if base_url == 'local':
+        return tile_server()
+    return base_url
+
+
+@st.experimental_memo
+def local_map_html(base_url, layers_mtime):
+    # prebuilt tile pyramid (python -m landcover.tiles), no Earth Engine;
+    # layers_mtime only keys the cache so a rebuilt pyramid is picked up
+    Map = foliumap.Map(center = [41.902782, 12.496366],
+                       zoom = 8, ee_initialize = False)
+    for layer_id, name, shown in map_layers:
+        Map.add_tile_layer(tiles.tile_url(base_url, layer_id), name = name,
+                           attribution = 'Copernicus Sentinel-2', shown = shown)
+    Map.add_legend(legend_title="NLCD Land Cover Classification", legend_dict=color_dict)
+    return Map.to_html(height = '600px')
+
+
+def map_html():
+    available = tiles.read_layers(TILES_DIR)
+    pyramid = all(layer_id in available for layer_id, _, _ in map_layers)
+    base_url = tile_base_url()
+    if pyramid and base_url:
+        layers_mtime = os.path.getmtime(os.path.join(TILES_DIR, 'layers.json'))
+        return local_map_html(base_url, layers_mtime)
+    if pyramid:
+        st.info(f'A tile pyramid is available in `{TILES_DIR}` but `LANDCOVER_TILE_URL` is not set, so the map below is computed by Earth Engine on every rerun. Set it to the public URL serving `{TILES_DIR}`, or to `local` when the browser runs on this machine.')
+    else:
+        st.caption('Map layers are computed live by Earth Engine on every rerun: build them once with `python -m landcover.tiles` and set `LANDCOVER_TILE_URL` to serve them instead.')
+    # Earth Engine tile URLs carry expiring tokens: never cached
+    import ee
+    Map = foliumap.Map(center = [41.902782, 12.496366],
+                       zoom = 8)
+    lazio_TCI = ee.Image('users/federicopavesiwork/Lazio_2018_TCI')
+    mlp11 = ee.Image('users/federicopavesiwork/MLP_1x1')
+    mlp33 = ee.Image('users/federicopavesiwork/MLP_3x3')
+    rf11 = ee.Image('users/federicopavesiwork/RF_1x1')
+    rf33 = ee.Image('users/federicopavesiwork/RF_3x3')
+
+    Map.addLayer(lazio_TCI, rgb_params, name = 'Lazio TCI')
+    Map.addLayer(mlp11, viz_params, name = 'MLP 1x1', shown = False)
+    Map.addLayer(mlp33, viz_params, name = 'MLP 3x3', shown = False)
+    Map.addLayer(rf11, viz_params, name = 'RF 1x1', shown = False)
+    Map.addLayer(rf33, viz_params, name = 'RF 3x3', shown = False)
+    Map.add_legend(legend_title="NLCD Land Cover Classification", legend_dict=color_dict)
+    return Map.to_html(height = '600px')
+
+
+components.html(map_html(), height = 600)
 
 
 st.markdown('Figures below provide an overview of the __comparison between Lucas statistics and statistics obtained by applying our classifiers__ (respectively, random forest 1x1, multi-layer perceptron 1x1, random forest 3x3 and multi-layer perceptron 3x3). Notice for __RF 3x3 we were only able to compute two trials as computational time was prohibitive__. What we can appreciate is all algorithms produce distributions relatively close to each other, with a Kullback-Leibler divergence from Lucas distribution of around 0.42. RF 3x3 seems the closest one with a score of around 0.41, while conversely MLP 3x3 seems most different scoring 0.46. Unfortunately, __even considering the closest prediction, we are far from producing a reliable soil classification__. All classifiers tend to largely overestimate shrubland, wetlands and water; while at the same time they considerably underestimate croplands and woodlands. Anyway, is __something we should expect__: as mentioned previously, __land cover classes are defined by something that goes beyond pure reflectance values__, they are complex structures of somehow interacting pixels. Sticking to previous example, a cropland could be defined as a specific structure of a network of pixels: if we see only one green pixel, it is hard to tell what it might belong to, looking instead at a parallelepiped shaped cluster of green pixels, we are prone to think it is a cropland, if we see a collection of adjacent structures of this kind (with eventually some interruption as a street for example) confidence our guess was correct is significantly increased. Moreover, we can spot two other sources of bias in this approach. First, as we already discussed, choosing pixel’s median reflectance especially over one year involves seasonality issues (like snow coverage , water level or croplands stages). Second, it is not simple to tell in which measure Lucas statistics are precise as they are computed using a survey approach (manually weighting recorded points) and we might assume they had to face issues similar to what we encountered (as for example seasonality for water levels).')
@@ -0,0 +1,85 @@
+import os
+import pandas as pd
+import streamlit as st
+from landcover import benchmark, timing
+
+
+
+st.markdown('# Performance')
+
+st.markdown('Previous sections discuss the __accuracy__ of each classifier; this page collects __how long each step of the pipeline takes and how much memory it needs__. Figures come from two sources: the __benchmark suite__ (`python -m landcover.benchmark`), which runs every stage on synthetic Sentinel-2 data with the same shape as ours (uint16 reflectances, 12 bands, 1x1 and 3x3 patches), and the __timings recorded by the real pipeline__ (extraction, experiments, classification and map tiles) when the `LANDCOVER_TIMINGS` environment variable names a file to append them to.')
+
+
+BENCHMARKS_DIR = 'benchmarks'
+TIMINGS_PATH = os.environ.get('LANDCOVER_TIMINGS', 'timings.jsonl')
+
+accuracy = pd.DataFrame({'Test accuracy' : ['52/53%', '52/53%', '57/58%', '60/61%'],
+                         'KL divergence from Lucas' : ['~0.42', '~0.41', '~0.42', '~0.46']},
+                        index = ['RF 1x1', 'RF 3x3', 'MLP 1x1', 'MLP 3x3'])
+
+models = {'RF 1x1' : ('train_rf_1x1', 'predict_rf_1x1', None),
+          'RF 3x3' : ('train_rf_3x3', 'predict_rf_3x3', None),
+          'MLP 1x1' : ('train_mlp_1x1', 'predict_mlp_1x1', 'classify_mlp_1x1'),
+          'MLP 3x3' : ('train_mlp_3x3', 'predict_mlp_3x3', 'classify_mlp_3x3')}
+
+
+def stage_table(records):
+    rows = []
+    for record in records:
+        rows.append({'Stage' : record['stage'],
+                     'Seconds' : record.get('seconds'),
+                     'Items' : record.get('items'),
+                     'Items / s' : record.get('items_per_second'),
+                     'Peak RSS (MB)' : record.get('peak_rss_mb'),
+                     'Workers peak RSS (MB)' : record.get('peak_rss_children_mb'),
+                     'Note' : record.get('skipped') or record.get('error') or ''})
+    return pd.DataFrame(rows)
+
+
+def model_table(report):
+    stages = report['stages']
+    speed = lambda name: stages.get(name, {}).get('items_per_second')
+    rows = {}
+    for model, (train, predict, classify) in models.items():
+        rows[model] = {'Training (s)' : stages.get(train, {}).get('seconds'),
+                       'Prediction (px/s, one core)' : speed(predict),
+                       'Map classification (px/s, all cores)' : speed(classify)}
+    return accuracy.join(pd.DataFrame.from_dict(rows, orient = 'index'))
+
+
+## BENCHMARKS #################################################################
+
+st.markdown('### Benchmark suite')
+
+path = benchmark.latest(BENCHMARKS_DIR)
+if path is None:
+    st.markdown(f'No benchmark report found in `{BENCHMARKS_DIR}`: run `python -m landcover.benchmark --out {BENCHMARKS_DIR}` to produce one.')
+    st.table(accuracy)
+else:
+    report = benchmark.load(path)
+    machine = report['machine']
+    st.markdown(f'Latest report: `{os.path.basename(path)}`, measured on {machine["cpu_count"]} cores ({machine["processor"]}, {machine["platform"]}), Python {machine["python"]}, problem sizes x{report["scale"]}.')
+
+    st.markdown('The table puts __speed next to the accuracy figures__ of the Algorithms training and Map classification sections. Training times refer to one fit of the structure chosen in the tuning step (3x3 with flips and rotations; MLP fits only run a few epochs, while the real ones run 600). Prediction speeds are measured on a single core, as map classification runs one model per core.')
+    st.table(model_table(report))
+
+    st.markdown('Every stage of the suite, with the peak memory of the process that ran it:')
+    st.dataframe(stage_table(report['stages'].values()))
+
+    previous = sorted(p for p in os.listdir(BENCHMARKS_DIR) if p.endswith('.json'))[:-1]
+    if previous:
+        old = st.selectbox('Compare with an earlier report', previous[::-1])
+        rows = benchmark.compare(benchmark.load(os.path.join(BENCHMARKS_DIR, old)), report)
+        st.dataframe(pd.DataFrame(rows))
+
+
+## PIPELINE TIMINGS ###########################################################
+
+st.markdown('### Pipeline timings')
+
+records = timing.read_records(TIMINGS_PATH)
+if records:
+    st.markdown(f'Stages recorded in `{TIMINGS_PATH}`, most recent first.')
+    st.dataframe(stage_table(records[::-1]))
+else:
+    st.markdown(f'No pipeline timings in `{TIMINGS_PATH}` yet: set `LANDCOVER_TIMINGS={TIMINGS_PATH}` before running extraction, experiments, classification or `python -m landcover.tiles`.')
@@ -0,0 +1,75 @@
+import datetime
+import os
+
+import numpy as np
+import pytest
+
+from landcover.extraction import (LocalBackend, LucasPoint, extract, finished_points,
+                                  load_patches)
+
+
+@pytest.fixture
+def points():
+    rng = np.random.default_rng(0)
+    return [LucasPoint(f'{i:06d}', rng.uniform(40, 43), rng.uniform(9, 12),
+                       datetime.date(2018, 4, 1) + datetime.timedelta(days = int(d)),
+                       'A', 'IT', 0)
+            for i, d in enumerate(rng.integers(0, 10, 300))]
+
+
+def patches_by_id(out_dir):
+    ids, patches = load_patches(out_dir)
+    assert len(set(ids.tolist())) == len(ids)
+    return dict(zip(ids.tolist(), patches))
+
+
+@pytest.fixture
+def reference(points, tmp_path):
+    out_dir = tmp_path / 'reference'
+    extract(points, LocalBackend(), out_dir, workers = 2)
+    return patches_by_id(out_dir)
+
+
+def test_transient_failures_are_retried(points, reference, tmp_path):
+    backend = LocalBackend(failure_rate = 0.3)
+    summary = extract(points, backend, tmp_path / 'out', workers = 4,
+                      retries = 20, backoff = 0.0)
+    assert summary['failed_groups'] == []
+    assert summary['fetched'] == len(points)
+    assert backend.requests > summary['groups']
+    got = patches_by_id(tmp_path / 'out')
+    assert got.keys() == reference.keys()
+    for point_id, patch in reference.items():
+        np.testing.assert_array_equal(got[point_id], patch)
+
+
+def test_resume_fetches_only_missing_points(points, reference, tmp_path):
+    out_dir = tmp_path / 'out'
+    first = extract(points, LocalBackend(failure_rate = 0.5), out_dir,
+                    workers = 4, retries = 0, backoff = 0.0)
+    assert first['failed_groups']
+    assert 0 < first['fetched'] < len(points)
+
+    backend = LocalBackend()
+    second = extract(points, backend, out_dir, workers = 4)
+    assert second['already_done'] == first['fetched']
+    assert second['fetched'] == len(points) - first['fetched']
+    assert backend.requests == second['groups']
+    assert finished_points(out_dir) == {p.point_id for p in points}
+    got = patches_by_id(out_dir)
+    for point_id, patch in reference.items():
+        np.testing.assert_array_equal(got[point_id], patch)
+
+
+def test_partial_shards_from_a_killed_run_are_ignored(points, reference, tmp_path):
+    out_dir = tmp_path / 'out'
+    extract(points[:100], LocalBackend(), out_dir, workers = 2)
+    leftovers = [out_dir / 'tmp-20180201-20180501_40_9_0123456789.npz',
+                 out_dir / 'shard-20180201-20180501_40_9_0123456789.npz.tmp.npz']
+    for path in leftovers:
+        path.write_bytes(b'PK\x03\x04 truncated')
+
+    summary = extract(points, LocalBackend(), out_dir, workers = 2)
+    assert summary['already_done'] == 100
+    assert not any(os.path.exists(path) for path in leftovers)
+    assert patches_by_id(out_dir).keys() == reference.keys()
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+from landcover import N_BANDS
+from landcover.features import flatten_patches, iter_feature_batches
+
+
+ROWS, COLS = 23, 17
+
+
+def naive_features(cube, window):
+    """Per-pixel loop over an edge-padded cube, flattened like training patches."""
+    halo = window // 2
+    padded = np.pad(cube, ((halo, halo), (halo, halo), (0, 0)), mode = 'edge')
+    features = np.empty((ROWS, COLS, window * window * N_BANDS), dtype = cube.dtype)
+    for r in range(ROWS):
+        for c in range(COLS):
+            patch = padded[r:r + window, c:c + window][None]
+            features[r, c] = flatten_patches(patch)[0]
+    return features
+
+
+@pytest.fixture
+def cube():
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 10000, (ROWS, COLS, N_BANDS), dtype = np.uint16)
+
+
+@pytest.mark.parametrize('window', [1, 3])
+@pytest.mark.parametrize('batch_size', [1, 7, 100, 65536])
+@pytest.mark.parametrize('masked', [False, True])
+def test_batches_match_naive_loop(cube, window, batch_size, masked):
+    halo = window // 2
+    block = np.pad(cube, ((halo, halo), (halo, halo), (0, 0)), mode = 'edge')
+    valid = None
+    if masked:
+        valid = np.random.default_rng(1).random((ROWS, COLS)) < 0.6
+    expected = naive_features(cube, window)
+
+    seen = np.zeros((ROWS, COLS), dtype = bool)
+    for rows, cols, X in iter_feature_batches(block, window, valid, batch_size):
+        assert X.shape[0] <= batch_size
+        assert X.dtype == cube.dtype
+        np.testing.assert_array_equal(X, expected[rows, cols])
+        assert not seen[rows, cols].any()
+        seen[rows, cols] = True
+
+    np.testing.assert_array_equal(seen, np.ones_like(seen) if valid is None else valid)